@@ -0,0 +1,256 @@
+from argparse import ArgumentParser
+from ast import literal_eval
+from collections import Counter
+from datetime import datetime as dt
+from hashlib import blake2b
+import json
+from math import log
+from pathlib import Path
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from logs import SegmentedLog
+
+
+LINE_RE = re.compile(r"(-?\d+) time='([^']*)' \[([\w-]+)\](.*)")
+TEXT_RE = re.compile(r""" (?:text|question)=('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+WIKI_HITS = {'wiki-found', 'wiki-resolved'}
+WIKI_MISSES = {
+    'wiki-no-res', 'wiki-no-page', 'wiki-timeout',
+    'wiki-exc-double', 'wiki-unkn-exc-double', 'wiki-unkn-exc-page',
+}
+
+
+class HeavyHitters:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Any, int] = {}
+
+    def add(self, item: Any) -> None:
+        if item in self.counts:
+            self.counts[item] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = 1
+        else:
+            self.counts = {key: count - 1 for key, count in self.counts.items() if count > 1}
+
+    def top(self, k: int) -> List[Tuple[Any, int]]:
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:k]
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item: Any) -> None:
+        digest = blake2b(str(item).encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'big')
+        bits = 64 - self.precision
+        idx = value >> bits
+        rank = bits - (value & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def __len__(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2. ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(m / zeros)
+        return round(estimate)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.
+
+    def add(self, ms: float) -> None:
+        self.buckets[max(0, int(ms * 1000)).bit_length()] += 1
+        self.count += 1
+        self.total += ms
+
+    def percentile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return (1 << bucket) / 1000
+        return 0.
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count else 0.,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+        }
+
+
+class LogStats:
+    def __init__(self, top_capacity: int = 1000):
+        self.lines = 0
+        self.unparsed = 0
+        self.tags: Counter = Counter()
+        self.hours: Counter = Counter()
+        self.texts = HeavyHitters(top_capacity)
+        self.users = HeavyHitters(top_capacity)
+        self.distinct_users = HyperLogLog()
+        self.latency: Dict[str, Dict[str, LatencyHistogram]] = {}
+        self._hour_keys: Dict[str, Optional[str]] = {}
+
+    def _hour(self, time: str) -> Optional[str]:
+        prefix = time[:-6]
+        if prefix not in self._hour_keys:
+            try:
+                self._hour_keys[prefix] = dt.strptime(prefix, '%d %b %Y %H').strftime('%Y-%m-%d %H:00')
+            except ValueError:
+                self._hour_keys[prefix] = None
+        return self._hour_keys[prefix]
+
+    def add_line(self, line: str) -> None:
+        self.lines += 1
+        if line.startswith('{'):
+            self.add_event(line)
+            return
+        match = LINE_RE.match(line)
+        if match is None:
+            self.unparsed += 1
+            return
+        uid, time, tag, rest = match.groups()
+        self.tags[tag] += 1
+        if tag.startswith('wiki-'):
+            return
+
+        hour = self._hour(time)
+        if hour is not None:
+            self.hours[hour] += 1
+        self.users.add(int(uid))
+        self.distinct_users.add(uid)
+        text = TEXT_RE.search(rest)
+        if text is not None:
+            try:
+                self.texts.add(literal_eval(text.group(1)).strip().lower())
+            except (ValueError, SyntaxError):
+                pass
+
+    def add_event(self, line: str) -> None:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self.unparsed += 1
+            return
+        if event.get('event') != 'message':
+            return
+        stages = self.latency.setdefault(event.get('tag', '?'), {})
+        for key, value in event.items():
+            if key.endswith('_ms'):
+                stages.setdefault(key[:-3], LatencyHistogram()).add(value)
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        hits = sum(self.tags[tag] for tag in WIKI_HITS)
+        misses = sum(self.tags[tag] for tag in WIKI_MISSES)
+        lookups = hits + misses
+        return {
+            'lines': self.lines,
+            'unparsed': self.unparsed,
+            'messages': sum(n for tag, n in self.tags.items() if not tag.startswith('wiki-')),
+            'distinct_users': len(self.distinct_users),
+            'tags': dict(self.tags.most_common()),
+            'hours': dict(sorted(self.hours.items())),
+            'wiki': {
+                'lookups': lookups,
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / lookups, 4) if lookups else None,
+                'outcomes': {tag: self.tags[tag] for tag in sorted(WIKI_HITS | WIKI_MISSES)},
+            },
+            'top_texts': self.texts.top(top),
+            'top_users': self.users.top(top),
+            'latency': {
+                tag: {stage: hist.summary() for stage, hist in sorted(stages.items())}
+                for tag, stages in sorted(self.latency.items())
+            },
+        }
+
+
+def read_lines(paths: Iterable[Path]) -> Iterator[str]:
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', errors='replace', buffering=1 << 20) as file:
+            yield from file
+
+
+def analyze(paths: Iterable[Path], top_capacity: int = 1000) -> LogStats:
+    stats = LogStats(top_capacity)
+    for line in read_lines(paths):
+        stats.add_line(line)
+    return stats
+
+
+def format_text(report: Dict[str, Any]) -> str:
+    lines = [
+        f'lines: {report["lines"]} (unparsed {report["unparsed"]})',
+        f'messages: {report["messages"]}, distinct users: ~{report["distinct_users"]}',
+        '',
+        'tags:',
+        *(f'  {tag:<24}{n:>10}' for tag, n in report['tags'].items()),
+        '',
+        'wiki: {lookups} lookups, {hits} hits, {misses} misses, hit rate {hit_rate}'.format(**report['wiki']),
+        '',
+        'messages per hour:',
+        *(f'  {hour}{n:>10}' for hour, n in report['hours'].items()),
+        '',
+        'top texts (lower bounds):',
+        *(f'  {n:>8}  {text!r}' for text, n in report['top_texts']),
+        '',
+        'top users (lower bounds):',
+        *(f'  {n:>8}  {uid}' for uid, n in report['top_users']),
+    ]
+    if report.get('missing_segments'):
+        lines += [
+            '',
+            f'missing sealed segments (not in this report, use --fetch): {len(report["missing_segments"])}',
+            *(f'  {name}' for name in report['missing_segments']),
+        ]
+    if report['latency']:
+        lines += ['', 'latency by tag and stage (p50 / p90 / p99 ms):']
+        for tag, stages in report['latency'].items():
+            lines.append(f'  {tag}')
+            lines += [
+                f'    {stage:<16}{s["p50_ms"]:>10.3f}{s["p90_ms"]:>10.3f}{s["p99_ms"]:>10.3f}  n={s["count"]}'
+                for stage, s in stages.items()
+            ]
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Summarize userlogs.log and its sealed segments in one pass')
+    parser.add_argument('logs', nargs='*', help='log files to read (default: local segments + userlogs.log)')
+    parser.add_argument('--log-dir', default='logs')
+    parser.add_argument('--fetch', action='store_true', help='download sealed segments missing locally from the cloud')
+    parser.add_argument('--format', choices=['text', 'json'], default='text')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--capacity', type=int, default=1000, help='counters kept for the top texts/users')
+    args = parser.parse_args()
+
+    userlog = None
+    if args.logs:
+        paths = [Path(path) for path in args.logs]
+    elif args.fetch:
+        from utils import log_paths, userlog
+        paths = log_paths()
+    else:
+        userlog = SegmentedLog('userlogs.log', args.log_dir)
+        paths = userlog.paths()
+    report = analyze(paths, args.capacity).report(args.top)
+    if userlog is not None:
+        report['missing_segments'] = userlog.missing()
+    if args.format == 'json':
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+    else:
+        print(format_text(report))
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Dict, Optional, Tuple
+
+
+class AnswerCache:
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS answers ('
+        'key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)'
+    )
+    LOAD = 'SELECT key, answer, expires FROM answers WHERE expires > ? ORDER BY used DESC LIMIT ?'
+    PUT = 'INSERT OR REPLACE INTO answers (key, answer, expires, used) VALUES (?, ?, ?, ?)'
+    TOUCH = 'UPDATE answers SET used = ? WHERE key = ?'
+    DELETE = 'DELETE FROM answers WHERE key = ?'
+    PURGE = 'DELETE FROM answers WHERE expires <= ?'
+
+    def __init__(self,
+                 path: str,
+                 capacity: int = 20000,
+                 ttl_secs: float = 30 * 24 * 60 * 60,
+                 negative_ttl_secs: float = 30 * 60):
+        self.path = path
+        self.capacity = capacity
+        self.ttl_secs = ttl_secs
+        self.negative_ttl_secs = negative_ttl_secs
+
+        self._lock = Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._entries: OrderedDict = OrderedDict()
+        self._touched: Dict[str, float] = {}
+
+    def _open(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(self.SCHEMA)
+            now = time()
+            self._db.execute(self.PURGE, (now,))
+            rows = self._db.execute(self.LOAD, (now, self.capacity)).fetchall()
+            self._db.commit()
+            for key, answer, expires in reversed(rows):
+                self._entries[key] = (answer, expires)
+        return self._db
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            self._open()
+            entry: Optional[Tuple[str, float]] = self._entries.get(key)
+            if entry is None:
+                return None
+            answer, expires = entry
+            now = time()
+            if expires <= now:
+                del self._entries[key]
+                self._touched.pop(key, None)
+                self._db.execute(self.DELETE, (key,))
+                self._db.commit()
+                return None
+            self._entries.move_to_end(key)
+            self._touched[key] = now
+            return answer
+
+    def put(self, key: str, answer: str) -> None:
+        now = time()
+        expires = now + (self.ttl_secs if answer else self.negative_ttl_secs)
+        with self._lock:
+            db = self._open()
+            self._entries[key] = (answer, expires)
+            self._entries.move_to_end(key)
+            self._touched.pop(key, None)
+            db.execute(self.PUT, (key, answer, expires, now))
+            while len(self._entries) > self.capacity:
+                evicted, _ = self._entries.popitem(last=False)
+                self._touched.pop(evicted, None)
+                db.execute(self.DELETE, (evicted,))
+            db.commit()
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._db is None or not self._touched:
+                return
+            touched = [(used, key) for key, used in self._touched.items()]
+            self._touched.clear()
+            self._db.executemany(self.TOUCH, touched)
+            self._db.commit()
+
+    def backup(self, dest: str) -> None:
+        self.sync()
+        with self._lock:
+            target = sqlite3.connect(dest)
+            try:
+                self._open().backup(target)
+            finally:
+                target.close()
+
+    def close(self) -> None:
+        self.sync()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,18 +1,25 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+import os
 from random import choice
 import re
+from secrets import token_urlsafe
+import signal
 import sys
 from threading import Thread
-from time import sleep
+from time import perf_counter, sleep
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import telebot as tb
-import wikipedia as wiki
+from telebot.async_telebot import AsyncTeleBot
 
 from classifiers import (
     MEDIA_TYPES,
     is_greeting, is_imperative, is_easter,
     is_toxic, is_personal, is_question,
 )
+from dispatch import Dispatcher
 from fallbacks import (
     LYCEUM_STICKERS, GREETINGS, IMPERATIVES,
     EASTER_ANSWERS, TOXIC_ANSWERS, PERSONAL_ANSWERS,
@@ -21,6 +28,8 @@ from fallbacks import (
 from ngrams import Talker
 from tasks import TASKS, MAX_ATTEMPTS
 from utils import *
+from warmup import warm_up
+from webhook import WebhookServer
 
 
 class ExceptionHandler:
@@ -33,101 +42,114 @@ class ExceptionHandler:
             sys.exit(0)
 
 
+USE_DISPATCHER = bool(DISPATCH_WORKERS) and BOT_RUNTIME in ('sync', 'webhook')
+
 bot = tb.TeleBot(
     BOT_TOKEN,
     exception_handler=ExceptionHandler(),
+    threaded=not USE_DISPATCHER,
 )
 
 
+class Reply(NamedTuple):
+    text: Optional[str] = None
+    sticker: Optional[str] = None
+
+
+HANDLERS: List[Tuple[str, Callable[[tb.types.Message], Iterator[Reply]], Dict[str, Any]]] = []
+
+
+def handler(tag: str, **filters: Any) -> Callable:
+    def decorator(func: Callable[[tb.types.Message], Iterator[Reply]]) -> Callable:
+        HANDLERS.append((tag, func, filters))
+        return func
+    return decorator
+
+
 # Media handler
-@bot.message_handler(content_types=MEDIA_TYPES)
-def media_content(msg: tb.types.Message) -> None:
+@handler('media', content_types=MEDIA_TYPES)
+def media_content(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
-    cloud_download_files()
+    ensure_files()
 
     sticker = choice(LYCEUM_STICKERS)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[media]', f'{sticker=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='media', sticker=sticker)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='media', sticker=sticker)
 
-    bot.send_sticker(uid, sticker)
+    yield Reply(sticker=sticker)
 
 
 # Text handlers
-@bot.message_handler(func=lambda msg: len(msg.text) > MAX_QUESTION_LEN)
-def too_long(msg: tb.types.Message) -> None:
+@handler('too-long', func=tracer.filter(lambda msg: len(msg.text) > MAX_QUESTION_LEN))
+def too_long(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = choice(QA_TOO_LONG)
     text = f'{text[:MAX_QUESTION_LEN]}<...>'
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[too-long]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='too-long', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='too-long', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_toxic(msg.text))
-def toxic_response(msg: tb.types.Message) -> None:
+@handler('toxic', func=tracer.filter(lambda msg: is_toxic(msg.text)))
+def toxic_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = choice(TOXIC_ANSWERS)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[toxic]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='toxic', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='toxic', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_easter(msg.text))
-def easter_response(msg: tb.types.Message) -> None:
+@handler('easter', func=tracer.filter(lambda msg: is_easter(msg.text)))
+def easter_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = choice(EASTER_ANSWERS)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[easter]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='easter', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='easter', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_imperative(msg.text))
-def imperative_response(msg: tb.types.Message) -> None:
+@handler('imperative', func=tracer.filter(lambda msg: is_imperative(msg.text)))
+def imperative_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = choice(IMPERATIVES)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[imperative]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='imperative', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='imperative', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_personal(msg.text))
-def personal_response(msg: tb.types.Message) -> None:
+@handler('personal', func=tracer.filter(lambda msg: is_personal(msg.text)))
+def personal_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
 
@@ -135,46 +157,50 @@ def personal_response(msg: tb.types.Message) -> None:
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[personal]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='personal', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='personal', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_greeting(msg.text))
-def greeting_response(msg: tb.types.Message) -> None:
+@handler('greet', func=tracer.filter(lambda msg: is_greeting(msg.text)))
+def greeting_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = choice(GREETINGS)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[greet]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='greet', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='greet', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: is_question(msg.text))
-def qa_response(msg: tb.types.Message) -> None:
+@handler('qa', func=tracer.filter(lambda msg: is_question(msg.text)))
+def qa_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     question = msg.text
-    cloud_download_files()
+    ensure_files()
 
     if len(question) > MAX_QUESTION_LEN:
         answer = choice(QA_TOO_LONG)
         question = f'{question[:MAX_QUESTION_LEN]}<...>'
     else:
-        bot.send_message(uid, 'Хмм...', parse_mode='markdown')
-        page = fetch_wiki(question, uid)
-        answer = ''
-        if page is not None:
-            sentence = get_first_sentence(page.summary)
-            answer = postprocess_answer(sentence)
+        key = question_key(question)
+        answer = kb_answer(key.split())
+        if answer:
+            tracer.annotate(source='kb')
+        elif key and (answer := answer_cache.get(key)) is not None:
+            tracer.annotate(source='cache')
+        else:
+            yield Reply(text='Хмм...')
+            summary, status = fetch_wiki(question, uid)
+            answer = answer_from_summary(summary)
+            if key and status in WIKI_DEFINITE:
+                answer_cache.put(key, answer)
 
         if answer:
             answer = ''.join((
@@ -183,20 +209,20 @@ def qa_response(msg: tb.types.Message) -> None:
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     if answer:
-        bot.send_message(uid, answer, parse_mode='markdown')
+        yield Reply(text=answer)
     else:
         answer = choice(LYCEUM_STICKERS)
-        bot.send_sticker(uid, answer)
+        yield Reply(sticker=answer)
+        tracer.annotate(tag='qa-sticker')
 
     log(uid, f'{time=}', '[qa]', f'{question=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='qa', text=question, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='qa', text=question, answer=answer)
 
 
 # Commands
-@bot.message_handler(commands=['help'])
-def start_dialog(msg: tb.types.Message) -> None:
+@handler('help', commands=['help'])
+def start_dialog(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     answer = (
         'Котя устал, котя запутался? Я помогу, не парься ^^\n'
@@ -204,6 +230,7 @@ def start_dialog(msg: tb.types.Message) -> None:
         'Жми `/play`, чтобы поиграть. Но помни: поиграть можно лишь один раз, и прервать игру не выйдет!\n'
         'Если ты в игре, пиши `/repeat`, чтобы я скопипастил тебе вопрос и ты не листал вверх, коть\n'
         'Милашик, забыл, сколько баллов у тебя? Пиши `/score`. Только не часто ^^\n'
+        'Хочешь знать, кто тут самый умный котя? Жми `/top`. А своё место смотри через `/rank`.\n'
         'А ещё ты можешь мне просто _написать_. И мы поболтаем :)\n'
         'Масянь, я очень много всего знаю! Люблю питон, NLP, искусственный интеллект, кошечек и кондитерку.\n'
         'Если ты тоже пушистый, умный, безумный красавчик и/или просто котя и хочешь поболтать, то вот он я :)\n'
@@ -214,15 +241,14 @@ def start_dialog(msg: tb.types.Message) -> None:
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[help]')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='help', answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='help', answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(commands=['start'])
-def start_dialog(msg: tb.types.Message) -> None:
+@handler('start', commands=['start'])
+def start_dialog(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     answer = (
         'Муррр, кто это тут у нас?\n'
@@ -237,135 +263,192 @@ def start_dialog(msg: tb.types.Message) -> None:
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[start]')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='start', answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='start', answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(commands=['play'])
-def play_handler(msg: tb.types.Message) -> None:
+@handler('play', commands=['play'])
+def play_handler(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
-    cloud_download_files()
-    state = read_history(uid)
+    ensure_files()
+
+    intro = None
+    with user_state(uid) as state:
+        if state.is_playing():
+            answer = (
+                'Ты ведь уже начинал игру. Меня не проведёшь!\n'
+                'Я _котик_, конечно, но я не тупенький. Я просто маленький.'
+            )
+        else:
+            word_attempts = MORPH \
+                .parse('попытка')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(MAX_ATTEMPTS) \
+                .word
+            word_tasks = MORPH \
+                .parse('задачка')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(len(TASKS)) \
+                .word
+            answer = (
+                'Ну, ладненько, человек. Ты сам напросился...\n'
+                f'Я покажу тебе {len(TASKS)} {word_tasks} по питону. '
+                f'Для решения каждой тебе будет дано {MAX_ATTEMPTS} {word_attempts} \n'
+                'Если отвечаешь правильно, получаешь баллы. Нет -- не расстраивайся. '
+                '_Просто ты не шаришь в питоне_ :)\n'
+                'Когда ответишь на *все* вопросы, найди моего владельца. '
+                'Во-первых, он классный: с ним можно поболтать. А во-вторых, хватит и первого.\n'
+                'Удачи! Будь умным котей ^^\n'
+                'Ты вполне можешь пользоваться _чем угодно_. Но это не поможет...\n'
+                'Во всех задачах считай, что у меня на компе бесконечно много памяти, если что.\n'
+                'И да: юзай Python 3.3+ в реализации CPython (стандартный питон крч).\n'
+                'Мяу ^^'
+            )
+            intro = answer
+
+            state.start_play()
+            task = state.get_task()
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(task.points) \
+                .word
+            answer = (
+                'Котя, напрягись чутка! Задачки подъехали ^^\n'
+                f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
+                f'{task.formulate()}'
+            )
 
-    if state.is_playing():
-        answer = (
-            'Ты ведь уже начинал игру. Меня не проведёшь!\n'
-            'Я _котик_, конечно, но я не тупенький. Я просто маленький.'
-        )
-    else:
-        word_attempts = MORPH \
-            .parse('попытка')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(MAX_ATTEMPTS) \
-            .word
-        word_tasks = MORPH \
-            .parse('задачка')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(len(TASKS)) \
-            .word
-        answer = (
-            'Ну, ладненько, человек. Ты сам напросился...\n'
-            f'Я покажу тебе {len(TASKS)} {word_tasks} по питону. '
-            f'Для решения каждой тебе будет дано {MAX_ATTEMPTS} {word_attempts} \n'
-            'Если отвечаешь правильно, получаешь баллы. Нет -- не расстраивайся. '
-            '_Просто ты не шаришь в питоне_ :)\n'
-            'Когда ответишь на *все* вопросы, найди моего владельца. '
-            'Во-первых, он классный: с ним можно поболтать. А во-вторых, хватит и первого.\n'
-            'Удачи! Будь умным котей ^^\n'
-            'Ты вполне можешь пользоваться _чем угодно_. Но это не поможет...\n'
-            'Во всех задачах считай, что у меня на компе бесконечно много памяти, если что.\n'
-            'И да: юзай Python 3.3+ в реализации CPython (стандартный питон крч).\n'
-            'Мяу ^^'
-        )
-        bot.send_message(uid, answer, parse_mode='markdown')
+        task_id = state.tasks[-1] if state.tasks else None
+        state.append_history(uid=uid, tag='play', answer=answer)
 
-        state.start_play()
-        task = state.get_task()
+    time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
+    log(uid, f'{time=}', '[play]', task_id)
+    if intro is not None:
+        yield Reply(text=intro)
+    yield Reply(text=answer)
+
+
+@handler('repeat', commands=['repeat'])
+def repeat_task(msg: tb.types.Message) -> Iterator[Reply]:
+    uid = msg.chat.id
+    ensure_files()
+
+    with user_state(uid) as state:
+        if not state.is_playing() or not state.has_tasks():
+            answer = (
+                'Коть, иди поешь! Ты же не в игре :)\n'
+                'Жми /play, чтобы поиграть. Если, конечно, не играл уже...'
+            )
+        else:
+            task = state.get_task()
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(task.points) \
+                .word
+            answer = (
+                'Ой, ладно, *ладно*! Угомонись. Сейчас повторю условие. Но *только* потому что я добряк безмерный :)\n'
+                f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
+                f'{task.formulate()}'
+            )
+
+        task_id = state.tasks[-1] if state.tasks else None
+        state.append_history(uid=uid, tag='repeat', answer=answer)
+
+    time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
+    log(uid, f'{time=}', '[repeat]', task_id)
+
+    yield Reply(text=answer)
+
+
+@handler('score', commands=['score'])
+def ask_score(msg: tb.types.Message) -> Iterator[Reply]:
+    uid = msg.chat.id
+    ensure_files()
+
+    with user_state(uid) as state:
         word_points = MORPH \
             .parse('балл')[0] \
             .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(task.points) \
+            .make_agree_with_number(state.points) \
             .word
         answer = (
-            'Котя, напрягись чутка! Задачки подъехали ^^\n'
-            f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
-            f'{task.formulate()}'
+            'Повторяю. Но *только* потому что я добряк безмерный :)\n'
+            f'У тебя сейчас {state.points} {word_points}'
         )
 
+        state.append_history(uid=uid, tag='repeat', answer=answer)
+
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
-    task_id = state.tasks[-1] if state.tasks else None
-    log(uid, f'{time=}', '[play]', task_id)
-    state.append_history(uid=uid, tag='play', answer=answer)
-    save_history(uid, state)
+    log(uid, f'{time=}', '[score]', f'{answer=}')
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(commands=['repeat'])
-def repeat_task(msg: tb.types.Message) -> None:
+@handler('top', commands=['top'])
+def ask_top(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
-    cloud_download_files()
-    state = read_history(uid)
+    ensure_files()
 
-    if not state.is_playing() or not state.has_tasks():
+    top = LEADERBOARD.top(TOP_SIZE)
+    if not top:
         answer = (
-            'Коть, иди поешь! Ты же не в игре :)\n'
-            'Жми /play, чтобы поиграть. Если, конечно, не играл уже...'
+            'Пока что никто не играл. Даже обидно как-то :(\n'
+            'Жми /play и стань первым котей в топе ^^'
         )
     else:
-        task = state.get_task()
-        word_points = MORPH \
-            .parse('балл')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(task.points) \
-            .word
-        answer = (
-            'Ой, ладно, *ладно*! Угомонись. Сейчас повторю условие. Но *только* потому что я добряк безмерный :)\n'
-            f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
-            f'{task.formulate()}'
-        )
+        lines = []
+        for rank, user, points in top:
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(points) \
+                .word
+            mark = ' -- _это ты_ ^^' if user == uid else ''
+            lines.append(f'{rank}. *{points} {word_points}*{mark}')
+        answer = 'Самые умные котики-питонисты:\n\n' + '\n'.join(lines)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
-    task_id = state.tasks[-1] if state.tasks else None
-    log(uid, f'{time=}', '[repeat]', task_id)
-    state.append_history(uid=uid, tag='repeat', answer=answer)
-    save_history(uid, state)
+    log(uid, f'{time=}', '[top]', f'{len(top)=}')
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='top', answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(commands=['score'])
-def ask_score(msg: tb.types.Message) -> None:
+@handler('rank', commands=['rank'])
+def ask_rank(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
-    cloud_download_files()
-    state = read_history(uid)
+    ensure_files()
 
-    word_points = MORPH \
-        .parse('балл')[0] \
-        .inflect({'plur', 'nomn'}) \
-        .make_agree_with_number(state.points) \
-        .word
-    answer = (
-        'Повторяю. Но *только* потому что я добряк безмерный :)\n'
-        f'У тебя сейчас {state.points} {word_points}'
-    )
+    rank = LEADERBOARD.rank(uid)
+    if rank is None:
+        answer = (
+            'Коть, ты же ещё не играл! Какое тебе место?\n'
+            'Жми /play, и посмотрим, чего ты стоишь :)'
+        )
+    else:
+        answer = (
+            f'Ты на *{rank}* месте из {len(LEADERBOARD)}.\n'
+            'Но для меня ты всегда первый котя ^^'
+        )
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
-    log(uid, f'{time=}', '[score]', f'{answer=}')
-    state.append_history(uid=uid, tag='repeat', answer=answer)
-    save_history(uid, state)
+    log(uid, f'{time=}', '[rank]', f'{rank=}')
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='rank', answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
-@bot.message_handler(func=lambda msg: msg.text.startswith('/'))
-def bad_command(msg: tb.types.Message) -> None:
+@handler('bad-cmd', func=tracer.filter(lambda msg: msg.text.startswith('/')))
+def bad_command(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     answer = (
         'Бусь, ты опечатался! Я такой команды не знаю.\n'
@@ -374,106 +457,105 @@ def bad_command(msg: tb.types.Message) -> None:
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[bad-cmd]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='bad-cmd', text=text, answer=answer)
-    save_history(uid, state)
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='bad-cmd', text=text, answer=answer)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
 # Game mode
-@bot.message_handler(func=lambda msg: is_playing(msg.chat.id))
-def tasks_story_line(msg: tb.types.Message) -> None:
+@handler('tasks', func=tracer.filter(lambda msg: is_playing(msg.chat.id)))
+def tasks_story_line(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
-    state = read_history(uid)
-    answer = ''
+    with user_state(uid) as state:
+        answer = ''
 
-    task = state.get_task()
-    guessed = task.check_answer(text)
-    switched = False
-    state.attempts -= 1
+        task = state.get_task()
+        guessed = task.check_answer(text)
+        switched = False
+        state.attempts -= 1
 
-    if guessed:
-        state.points += task.points
-        switched = state.switch_task()
+        if guessed:
+            state.add_points(task.points)
+            switched = state.switch_task()
 
-        word_points = MORPH \
-            .parse('балл')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(state.points) \
-            .word
-        answer += (
-            'Ты ответил *верно*! Повезло тебе, наверное...\n'
-            f'Сейчас у тебя всего *{state.points} {word_points}*.'
-        )
-    else:
-        answer += (
-            'Ты ответил *неверно*. А подумать?\n'
-            'Мы вот, коты, всегда сначала думаем, потом ляпаем.'
-        )
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(state.points) \
+                .word
+            answer += (
+                'Ты ответил *верно*! Повезло тебе, наверное...\n'
+                f'Сейчас у тебя всего *{state.points} {word_points}*.'
+            )
+        else:
+            answer += (
+                'Ты ответил *неверно*. А подумать?\n'
+                'Мы вот, коты, всегда сначала думаем, потом ляпаем.'
+            )
 
-        if not state.attempts:
-            switched = state.switch_task()
+            if not state.attempts:
+                switched = state.switch_task()
+                answer += (
+                    '\n\nКотя, у тебя _закончились попытки_ :(\n'
+                    'Не расстраивайся! Нафиг нам эта задачка сдалась? Пойдём _чаёк пить_?..'
+                )
+
+        if switched:
+            task = state.get_task()
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(task.points) \
+                .word
             answer += (
-                '\n\nКотя, у тебя _закончились попытки_ :(\n'
-                'Не расстраивайся! Нафиг нам эта задачка сдалась? Пойдём _чаёк пить_?..'
+                '\n\nЧаёк откладывается, коть! Давай думать дальше, задачки-то ещё остались ^^\n'
+                f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
+                f'{task.formulate()}'
+            )
+        elif guessed or not state.attempts:
+            word_points = MORPH \
+                .parse('балл')[0] \
+                .inflect({'plur', 'nomn'}) \
+                .make_agree_with_number(state.points) \
+                .word
+            answer += (
+                '\n\nТы завершил свой квест! Молодец, котя ^^\n'
+                f'Ты набрал в общей сложности *{state.points} {word_points}*.\n'
+                'Подойди к моему владельцу и скажи ему, что вы оба классные :)\n'
             )
 
-    if switched:
-        task = state.get_task()
-        word_points = MORPH \
-            .parse('балл')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(task.points) \
-            .word
-        answer += (
-            '\n\nЧаёк откладывается, коть! Давай думать дальше, задачки-то ещё остались ^^\n'
-            f'Сейчас твоя задачка стоит *{task.points} {word_points}* и формулируется так.\n\n'
-            f'{task.formulate()}'
-        )
-    elif guessed or not state.attempts:
-        word_points = MORPH \
-            .parse('балл')[0] \
-            .inflect({'plur', 'nomn'}) \
-            .make_agree_with_number(state.points) \
-            .word
-        answer += (
-            '\n\nТы завершил свой квест! Молодец, котя ^^\n'
-            f'Ты набрал в общей сложности *{state.points} {word_points}*.\n'
-            'Подойди к моему владельцу и скажи ему, что вы оба классные :)\n'
-        )
+        state.append_history(uid=uid, tag='tasks', text=text, answer=answer)
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     log(uid, f'{time=}', '[tasks]', f'{text=}', f'{guessed}', f'{switched=}', f'{state.points=}')
-    state.append_history(uid=uid, tag='tasks', text=text, answer=answer)
-    save_history(uid, state)
 
-    bot.send_message(uid, answer, parse_mode='markdown')
+    yield Reply(text=answer)
 
 
 # Fallback handler
-@bot.message_handler(func=lambda msg: True)
-def fallback_response(msg: tb.types.Message) -> None:
+@handler('fallback', func=lambda msg: True)
+def fallback_response(msg: tb.types.Message) -> Iterator[Reply]:
     uid = msg.chat.id
     text = msg.text
-    cloud_download_files()
+    ensure_files()
 
     time = dt.fromtimestamp(msg.date).strftime('%d %b %Y %H:%M:%S')
     if roll_dice(STICKER_PROBABILITY):
         sticker = choice(LYCEUM_STICKERS)
-        bot.send_sticker(uid, sticker)
+        yield Reply(sticker=sticker)
 
         log(uid, f'{time=}', '[fallback]', f'{text=}', f'{sticker=}')
-        state = read_history(uid)
-        state.append_history(uid=uid, tag='fallback-sticker', text=text, answer=sticker)
-        save_history(uid, state)
+        tracer.annotate(tag='fallback-sticker')
+        with user_state(uid) as state:
+            state.append_history(uid=uid, tag='fallback-sticker', text=text, answer=sticker)
         return
 
     if roll_dice(NGRAM_PROBABILITY / (1 - STICKER_PROBABILITY)):
-        with lock:
+        with talker_lock, tracer.stage('talk'):
             answer = talker.talk(
                 text,
                 temperature=0.9,
@@ -486,37 +568,198 @@ def fallback_response(msg: tb.types.Message) -> None:
         answer = choice(FALLBACKS)
 
     log(uid, f'{time=}', '[fallback]', f'{text=}', f'{answer=}')
-    state = read_history(uid)
-    state.append_history(uid=uid, tag='fallback', text=text, answer=answer)
-    save_history(uid, state)
-
-    bot.send_message(uid, answer, parse_mode='markdown')
-
-
-def bot_thread():
+    with user_state(uid) as state:
+        state.append_history(uid=uid, tag='fallback', text=text, answer=answer)
+
+    yield Reply(text=answer)
+
+
+def send_reply(uid: int, reply: Reply) -> None:
+    with tracer.stage('send'):
+        if reply.sticker is not None:
+            bot.send_sticker(uid, reply.sticker)
+        else:
+            bot.send_message(uid, reply.text, parse_mode='markdown')
+
+
+def sync_handler(tag: str, func: Callable[[tb.types.Message], Iterator[Reply]]) -> Callable:
+    @tracer.handler(tag)
+    def handle(msg: tb.types.Message) -> None:
+        for reply in func(msg):
+            send_reply(msg.chat.id, reply)
+    return handle
+
+
+def matches(msg: tb.types.Message, filters: Dict[str, Any]) -> bool:
+    if msg.content_type not in filters.get('content_types', ['text']):
+        return False
+    commands = filters.get('commands')
+    if commands is not None and tb.util.extract_command(msg.text) not in commands:
+        return False
+    func = filters.get('func')
+    return func is None or func(msg)
+
+
+def match_handler(msg: tb.types.Message) -> Optional[Tuple[str, Callable]]:
+    for tag, func, filters in HANDLERS:
+        if matches(msg, filters):
+            return tag, func
+    return None
+
+
+ROUTES = [(filters, sync_handler(tag, func)) for tag, func, filters in HANDLERS]
+
+
+def route(msg: tb.types.Message) -> None:
+    for filters, handle in ROUTES:
+        if matches(msg, filters):
+            handle(msg)
+            return
+
+
+if USE_DISPATCHER:
+    dispatcher = Dispatcher(route, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE)
+    bot.register_message_handler(dispatcher.submit, content_types=['text', *MEDIA_TYPES])
+else:
+    dispatcher = None
+    for filters, handle in ROUTES:
+        bot.register_message_handler(handle, **filters)
+
+
+async def handle_async(abot: AsyncTeleBot,
+                       executor: ThreadPoolExecutor,
+                       tag: str,
+                       func: Callable[[tb.types.Message], Iterator[Reply]],
+                       msg: tb.types.Message) -> None:
+    loop = asyncio.get_running_loop()
+    trace = tracer.start(msg, tag)
+    replies = func(msg)
+    try:
+        while True:
+            reply = await loop.run_in_executor(executor, tracer.run, trace, next, replies, None)
+            if reply is None:
+                break
+            start = perf_counter()
+            if reply.sticker is not None:
+                await abot.send_sticker(msg.chat.id, reply.sticker)
+            else:
+                await abot.send_message(msg.chat.id, reply.text, parse_mode='markdown')
+            trace.add('send', perf_counter() - start)
+    except BaseException as err:
+        trace.fields['error'] = type(err).__name__
+        raise
+    finally:
+        tracer.finish(trace)
+
+
+def async_router(abot: AsyncTeleBot, executor: ThreadPoolExecutor) -> Callable:
+    chats: Dict[int, List[Any]] = {}
+
+    async def route_async(msg: tb.types.Message) -> None:
+        chat = chats.setdefault(msg.chat.id, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                loop = asyncio.get_running_loop()
+                found = await loop.run_in_executor(executor, match_handler, msg)
+                if found is not None:
+                    await handle_async(abot, executor, *found, msg)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del chats[msg.chat.id]
+    return route_async
+
+
+def prepare() -> None:
     cloud_download_files()
+    index_users()
+    load_indexes()
+    logger.info(f'Loaded indexes: {len(PLAYING_USERS)} users are playing')
+    Thread(target=warm_up, daemon=True).start()
     talker.fit(*TEXT_PATHS)
     logger.info('Ngram model is fit!')
 
-    wiki.set_lang('ru')
+
+def bot_thread():
+    prepare()
     logger.info('Ready for polling!')
 
     bot.infinity_polling()
 
 
+async def run_async_bot() -> None:
+    executor = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix='handler')
+    abot = AsyncTeleBot(BOT_TOKEN)
+    abot.register_message_handler(async_router(abot, executor), content_types=['text', *MEDIA_TYPES])
+
+    await asyncio.get_running_loop().run_in_executor(executor, prepare)
+    logger.info('Ready for async polling!')
+    try:
+        await abot.infinity_polling()
+    finally:
+        await abot.close_session()
+        executor.shutdown(wait=False)
+
+
+def async_bot_thread():
+    asyncio.run(run_async_bot())
+
+
+def webhook_bot_thread():
+    prepare()
+    secret = WEBHOOK_SECRET or token_urlsafe(32)
+    server = WebhookServer(
+        bot.process_new_updates,
+        tb.types.Update.de_json,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret=secret,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        batch_size=WEBHOOK_BATCH_SIZE,
+    )
+    bot.remove_webhook()
+    bot.set_webhook(url=f'{WEBHOOK_URL}{WEBHOOK_PATH}', secret_token=secret)
+    logger.info(f'Serving webhook updates on {server.address}')
+
+    server.serve_forever()
+
+
+RUNTIMES = {
+    'sync': bot_thread,
+    'async': async_bot_thread,
+    'webhook': webhook_bot_thread,
+}
+
+
 def cloud_thread():
     while True:
         logger.info(f'Cloud thread gonna sleep for {CLOUD_SLEEP_MINS} mins...')
         sleep(60 * CLOUD_SLEEP_MINS)
         logger.info('Cloud thread woke up!')
+        if resync_files():
+            logger.info('Some files went missing, re-synced them from the cloud')
         cloud_upload_files()
         time = dt.now().strftime('%d %b %Y %H:%M:%S')
         log(f'{time=}', 'Uploaded files!')
+        if dispatcher is not None:
+            log_writer.write_event({'event': 'dispatch', 'workers': dispatcher.metrics()})
+
+
+def stop(signum: int, frame: Any) -> None:
+    logger.info(f'Got signal {signum}, flushing states and logs before exit...')
+    shutdown()
+    os._exit(0)
 
 
 if __name__ == '__main__':
+    if BOT_RUNTIME == 'webhook' and not WEBHOOK_URL:
+        sys.exit('WEBHOOK_URL must point at the public HTTPS proxy in front of the webhook server')
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
     talker = Talker(n=4, delta=1e-2)
-    bot_job = Thread(target=bot_thread)
+    bot_job = Thread(target=RUNTIMES[BOT_RUNTIME])
     cloud_job = Thread(target=cloud_thread)
 
     bot_job.start()
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+
+logger = getLogger(__name__)
+
+
+class StateCache:
+    def __init__(self,
+                 load: Callable[[int], Any],
+                 encode: Callable[[Any], List[Tuple[Any, bytes]]],
+                 write: Callable[[List[Tuple[Any, bytes]]], None],
+                 lock_for: Callable[[int], Lock],
+                 capacity: int = 4096,
+                 flush_secs: float = 30,
+                 max_dirty: int = 1024):
+        self._load = load
+        self._encode = encode
+        self._write = write
+        self._lock_for = lock_for
+        self.capacity = capacity
+        self.flush_secs = flush_secs
+        self.max_dirty = max_dirty
+
+        self._entries: OrderedDict = OrderedDict()
+        self._dirty: Dict[int, float] = {}
+        self._flushing: Set[int] = set()
+        self._backlog: List[Tuple[Any, bytes]] = []
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+
+        self._flusher = Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uid: int) -> Any:
+        with self._lock:
+            if uid in self._entries:
+                self._entries.move_to_end(uid)
+                return self._entries[uid]
+
+        state = self._load(uid)
+        with self._lock:
+            state = self._entries.setdefault(uid, state)
+            self._entries.move_to_end(uid)
+            self._evict()
+        return state
+
+    def mark_dirty(self, uid: int, state: Any) -> None:
+        with self._lock:
+            self._entries[uid] = state
+            self._entries.move_to_end(uid)
+            self._dirty.setdefault(uid, monotonic())
+            overflow = len(self._dirty) >= self.max_dirty
+        if overflow:
+            self._wakeup.set()
+
+    def _evict(self) -> None:
+        excess = len(self._entries) - self.capacity
+        if excess <= 0:
+            return
+        for uid in list(self._entries):
+            if uid not in self._dirty and uid not in self._flushing:
+                del self._entries[uid]
+                excess -= 1
+                if not excess:
+                    return
+        self._wakeup.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                uids = list(self._dirty)
+                self._dirty.clear()
+                self._flushing.update(uids)
+                states = [self._entries[uid] for uid in uids]
+
+            batch, self._backlog = self._backlog, []
+            try:
+                for uid, state in zip(uids, states):
+                    with self._lock_for(uid):
+                        batch.extend(self._encode(state))
+                if batch:
+                    self._write(batch)
+            except:
+                self._backlog = batch
+                with self._lock:
+                    for uid in uids:
+                        self._dirty.setdefault(uid, monotonic())
+                raise
+            finally:
+                with self._lock:
+                    self._flushing.difference_update(uids)
+                    self._evict()
+            return len(batch)
+
+    def _flush_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_secs)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('State cache flush failed')
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        self.flush()
@@ -0,0 +1,162 @@
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import random
+from shutil import copyfile, rmtree
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Any, Dict, List, Optional
+
+from requests.exceptions import ConnectionError
+from yadisk import YaDisk
+from yadisk.exceptions import ConflictError, PathExistsError, PathNotFoundError
+
+
+class LocalDisk:
+    def __init__(self,
+                 root: str,
+                 latency_secs: float = 0,
+                 throughput_bps: float = 0,
+                 conflict_prob: float = 0,
+                 error_prob: float = 0,
+                 seed: Optional[int] = None):
+        self.root = Path(root)
+        self.latency_secs = latency_secs
+        self.throughput_bps = throughput_bps
+        self.conflict_prob = conflict_prob
+        self.error_prob = error_prob
+        self._rng = random.Random(seed)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, path: str) -> Path:
+        return self.root / path.lstrip('/')
+
+    def _request(self, nbytes: int = 0, writes: bool = False) -> None:
+        sleep(self.latency_secs)
+        if self._rng.random() < self.error_prob:
+            raise ConnectionError('Injected connection error')
+        if writes and self._rng.random() < self.conflict_prob:
+            raise ConflictError()
+        if self.throughput_bps > 0 and nbytes:
+            sleep(nbytes / self.throughput_bps)
+
+    def exists(self, path: str) -> bool:
+        self._request()
+        return self._path(path).exists()
+
+    def mkdir(self, path: str) -> None:
+        self._request(writes=True)
+        self._path(path).mkdir(parents=True)
+
+    def remove(self, path: str, permanently: bool = False) -> None:
+        self._request(writes=True)
+        target = self._path(path)
+        if not target.exists():
+            raise PathNotFoundError()
+        if target.is_dir():
+            rmtree(target)
+        else:
+            target.unlink()
+
+    def upload(self, source: str, path: str) -> None:
+        self._request(Path(source).stat().st_size, writes=True)
+        target = self._path(path)
+        if target.exists():
+            raise PathExistsError()
+        if not target.parent.exists():
+            raise ConflictError()
+        copyfile(source, target)
+
+    def download(self, path: str, dest: str) -> None:
+        target = self._path(path)
+        if not target.exists():
+            self._request()
+            raise PathNotFoundError()
+        self._request(target.stat().st_size)
+        copyfile(target, dest)
+
+
+def open_cloud(kind: str, token: str, local_dir: str = 'cloud', **faults: Any) -> Any:
+    if kind == 'yadisk':
+        return YaDisk(token=token)
+    if kind == 'local':
+        return LocalDisk(local_dir, **faults)
+    raise ValueError(f'Unknown cloud backend: {kind}')
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': 1e3 * values[len(values) // 2],
+        'p99_ms': 1e3 * values[int(len(values) * 0.99)],
+        'max_ms': 1e3 * values[-1],
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Load-test the cloud sync path against a local fake disk')
+    parser.add_argument('--workdir', default='sync-bench', help='scratch directory for the bot files')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--sync-every', type=float, default=1, help='seconds between sync rounds')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--throughput-kbps', type=float, default=1024)
+    parser.add_argument('--conflict-prob', type=float, default=0.05)
+    parser.add_argument('--error-prob', type=float, default=0.05)
+    args = parser.parse_args()
+
+    os.environ.update({
+        'CLOUD_BACKEND': 'local',
+        'CLOUD_LOCAL_DIR': 'cloud',
+        'CLOUD_LATENCY_MS': str(args.latency_ms),
+        'CLOUD_THROUGHPUT_KBPS': str(args.throughput_kbps),
+        'CLOUD_CONFLICT_PROB': str(args.conflict_prob),
+        'CLOUD_ERROR_PROB': str(args.error_prob),
+        'UPLOAD_BACKOFF_SECS': '0.1',
+    })
+    Path(args.workdir).mkdir(parents=True, exist_ok=True)
+    os.chdir(args.workdir)
+
+    import utils
+
+    Path('cloud', utils.YADISK_PATH.lstrip('/')).mkdir(parents=True, exist_ok=True)
+    stop = Event()
+    handler_latencies: Dict[bool, List[float]] = {False: [], True: []}
+    sync_latencies: List[float] = []
+    syncing = Event()
+
+    def handler_loop(seed: int) -> None:
+        rng = random.Random(seed)
+        while not stop.is_set():
+            uid = rng.randrange(args.users)
+            during_sync = syncing.is_set()
+            start = perf_counter()
+            utils.log(uid, '[bench]', f'text={"x" * rng.randint(5, 100)!r}')
+            with utils.user_state(uid) as state:
+                state.append_history(uid=uid, tag='fallback', text='bench', answer='bench')
+            handler_latencies[during_sync].append(perf_counter() - start)
+
+    def sync_loop() -> None:
+        while not stop.wait(args.sync_every):
+            syncing.set()
+            start = perf_counter()
+            utils.cloud_upload_files()
+            sync_latencies.append(perf_counter() - start)
+            syncing.clear()
+
+    jobs = [Thread(target=handler_loop, args=(idx,)) for idx in range(args.threads)]
+    jobs.append(Thread(target=sync_loop))
+    for job in jobs:
+        job.start()
+    sleep(args.seconds)
+    stop.set()
+    for job in jobs:
+        job.join()
+
+    print('handlers, idle:', percentiles(handler_latencies[False]))
+    print('handlers, during sync:', percentiles(handler_latencies[True]))
+    print('sync rounds:', percentiles(sync_latencies))
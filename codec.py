@@ -0,0 +1,195 @@
+from enum import IntEnum
+import json
+import struct
+from typing import Any, Dict, List, Tuple
+
+
+VERSION = 1
+
+STATE_HEADER = struct.Struct('<BB')
+PLAYS_FLAG = 0x01
+
+
+class Tag(IntEnum):
+    CUSTOM = 0
+    MEDIA = 1
+    TOO_LONG = 2
+    TOXIC = 3
+    EASTER = 4
+    IMPERATIVE = 5
+    PERSONAL = 6
+    GREET = 7
+    QA = 8
+    HELP = 9
+    START = 10
+    PLAY = 11
+    REPEAT = 12
+    BAD_CMD = 13
+    TASKS = 14
+    FALLBACK = 15
+    FALLBACK_STICKER = 16
+    TOP = 17
+    RANK = 18
+
+    @property
+    def label(self) -> str:
+        return self.name.lower().replace('_', '-')
+
+
+class Key(IntEnum):
+    CUSTOM = 0
+    UID = 1
+    TEXT = 2
+    ANSWER = 3
+    STICKER = 4
+    DATE = 5
+
+
+class Kind(IntEnum):
+    NONE = 0
+    STR = 1
+    INT = 2
+
+
+TAGS = {tag.label: tag for tag in Tag if tag is not Tag.CUSTOM}
+KEYS = {key.name.lower(): key for key in Key if key is not Key.CUSTOM}
+
+
+def pack_varint(value: int, out: bytearray) -> None:
+    value = -2 * value - 1 if value < 0 else 2 * value
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def unpack_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos
+
+
+def pack_str(text: str, out: bytearray) -> None:
+    raw = text.encode('utf-8')
+    pack_varint(len(raw), out)
+    out += raw
+
+
+def unpack_str(data: bytes, pos: int) -> Tuple[str, int]:
+    size, pos = unpack_varint(data, pos)
+    return data[pos:pos + size].decode('utf-8'), pos + size
+
+
+def pack_value(value: Any, out: bytearray) -> None:
+    if value is None:
+        out.append(Kind.NONE)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        out.append(Kind.INT)
+        pack_varint(value, out)
+    else:
+        out.append(Kind.STR)
+        pack_str(str(value), out)
+
+
+def unpack_value(data: bytes, pos: int) -> Tuple[Any, int]:
+    kind = data[pos]
+    pos += 1
+    if kind == Kind.INT:
+        return unpack_varint(data, pos)
+    if kind == Kind.STR:
+        return unpack_str(data, pos)
+    return None, pos
+
+
+def is_json(data: bytes) -> bool:
+    return data[:1] == b'{'
+
+
+def pack_state(uid: int,
+               plays: bool,
+               tasks: List[int],
+               points: int,
+               attempts: int,
+               hseq: int) -> bytes:
+    out = bytearray(STATE_HEADER.pack(VERSION, PLAYS_FLAG if plays else 0))
+    for value in (uid, points, attempts, hseq, len(tasks), *tasks):
+        pack_varint(value, out)
+    return bytes(out)
+
+
+def unpack_state(data: bytes) -> Dict[str, Any]:
+    if is_json(data):
+        return json.loads(data.decode())
+
+    version, flags = STATE_HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'Unknown state record version: {version}')
+    pos = STATE_HEADER.size
+    uid, pos = unpack_varint(data, pos)
+    points, pos = unpack_varint(data, pos)
+    attempts, pos = unpack_varint(data, pos)
+    hseq, pos = unpack_varint(data, pos)
+    n_tasks, pos = unpack_varint(data, pos)
+    tasks = []
+    for _ in range(n_tasks):
+        task, pos = unpack_varint(data, pos)
+        tasks.append(task)
+    return {
+        'uid': uid,
+        'plays': bool(flags & PLAYS_FLAG),
+        'tasks': tasks,
+        'points': points,
+        'attempts': attempts,
+        'hseq': hseq,
+    }
+
+
+def pack_entry(entry: Dict[str, Any]) -> bytes:
+    out = bytearray((VERSION,))
+    label = entry.get('tag')
+    tag = TAGS.get(label, Tag.CUSTOM)
+    out.append(tag)
+    if tag is Tag.CUSTOM:
+        pack_value(label, out)
+
+    fields = [(name, value) for name, value in entry.items() if name != 'tag']
+    pack_varint(len(fields), out)
+    for name, value in fields:
+        key = KEYS.get(name, Key.CUSTOM)
+        out.append(key)
+        if key is Key.CUSTOM:
+            pack_str(name, out)
+        pack_value(value, out)
+    return bytes(out)
+
+
+def unpack_entry(data: bytes) -> Dict[str, Any]:
+    if is_json(data):
+        return json.loads(data.decode())
+
+    if data[0] != VERSION:
+        raise ValueError(f'Unknown history entry version: {data[0]}')
+    tag = Tag(data[1])
+    pos = 2
+    if tag is Tag.CUSTOM:
+        label, pos = unpack_value(data, pos)
+    else:
+        label = tag.label
+
+    fields, pos = unpack_varint(data, pos)
+    entry = {} if label is None else {'tag': label}
+    for _ in range(fields):
+        key = Key(data[pos])
+        pos += 1
+        if key is Key.CUSTOM:
+            name, pos = unpack_str(data, pos)
+        else:
+            name = key.name.lower()
+        entry[name], pos = unpack_value(data, pos)
+    return entry
@@ -0,0 +1,94 @@
+from logging import getLogger
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional
+
+
+logger = getLogger(__name__)
+
+
+class WorkerStats:
+    __slots__ = ('processed', 'failed', 'wait_secs', 'busy_secs', 'max_depth', '_lock')
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.wait_secs = 0.
+        self.busy_secs = 0.
+        self.max_depth = 0
+        self._lock = Lock()
+
+    def queued(self, depth: int) -> None:
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+
+    def done(self, wait_secs: float, busy_secs: float, failed: bool) -> None:
+        with self._lock:
+            self.processed += 1
+            self.failed += failed
+            self.wait_secs += wait_secs
+            self.busy_secs += busy_secs
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            n = max(1, self.processed)
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'max_depth': self.max_depth,
+                'mean_wait_ms': round(1e3 * self.wait_secs / n, 3),
+                'mean_busy_ms': round(1e3 * self.busy_secs / n, 3),
+            }
+
+
+class Dispatcher:
+    def __init__(self,
+                 handle: Callable[[Any], None],
+                 workers: int = 8,
+                 queue_size: int = 256,
+                 key: Callable[[Any], int] = lambda msg: msg.chat.id):
+        self.handle = handle
+        self.key = key
+        self._queues: List[Queue] = [Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._stats = [WorkerStats() for _ in self._queues]
+        self._workers = [
+            Thread(target=self._work, args=(idx,), name=f'dispatch-{idx}', daemon=True)
+            for idx in range(len(self._queues))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, msg: Any, timeout: Optional[float] = None) -> None:
+        idx = hash(self.key(msg)) % len(self._queues)
+        queue = self._queues[idx]
+        queue.put((msg, monotonic()), timeout=timeout)
+        self._stats[idx].queued(queue.qsize())
+
+    def _work(self, idx: int) -> None:
+        queue, stats = self._queues[idx], self._stats[idx]
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            msg, queued = item
+            started = monotonic()
+            failed = False
+            try:
+                self.handle(msg)
+            except Exception:
+                failed = True
+                logger.exception(f'Dispatcher worker {idx} failed to handle a message')
+            stats.done(started - queued, monotonic() - started, failed)
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        return [
+            {'worker': idx, 'depth': queue.qsize(), **stats.snapshot()}
+            for idx, (queue, stats) in enumerate(zip(self._queues, self._stats))
+        ]
+
+    def close(self) -> None:
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join()
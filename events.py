@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+CLASSIFY_ATTR = 'classify_secs'
+
+
+class Trace:
+    __slots__ = ('uid', 'tag', 'text_len', 'started', 'timings', 'fields')
+
+    def __init__(self, uid: int, tag: str, text_len: int, classify_secs: float = 0.):
+        self.uid = uid
+        self.tag = tag
+        self.text_len = text_len
+        self.started = perf_counter()
+        self.timings: Dict[str, float] = {'classify': classify_secs}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, stage: str, secs: float) -> None:
+        self.timings[stage] = self.timings.get(stage, 0.) + secs
+
+    def record(self) -> Dict[str, Any]:
+        record = {
+            'event': 'message',
+            'date': round(time(), 3),
+            'uid': self.uid,
+            'tag': self.tag,
+            'text_len': self.text_len,
+            'total_ms': round(1e3 * (perf_counter() - self.started), 3),
+        }
+        for stage, secs in self.timings.items():
+            record[f'{stage}_ms'] = round(1e3 * secs, 3)
+        record.update(self.fields)
+        return record
+
+
+class Tracer:
+    def __init__(self, emit: Callable[[Dict[str, Any]], None]):
+        self.emit = emit
+        self._local = local()
+
+    @property
+    def current(self) -> Optional[Trace]:
+        return getattr(self._local, 'trace', None)
+
+    def add(self, stage: str, secs: float) -> None:
+        trace = self.current
+        if trace is not None:
+            trace.add(stage, secs)
+
+    def annotate(self, **fields: Any) -> None:
+        trace = self.current
+        if trace is not None:
+            trace.fields.update(fields)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def filter(self, check: Callable[[Any], bool]) -> Callable[[Any], bool]:
+        @wraps(check)
+        def wrapper(msg: Any) -> bool:
+            start = perf_counter()
+            try:
+                return check(msg)
+            finally:
+                spent = getattr(msg, CLASSIFY_ATTR, 0.) + perf_counter() - start
+                setattr(msg, CLASSIFY_ATTR, spent)
+        return wrapper
+
+    def start(self, msg: Any, tag: str) -> Trace:
+        return Trace(msg.chat.id, tag, len(msg.text or ''), getattr(msg, CLASSIFY_ATTR, 0.))
+
+    def finish(self, trace: Trace) -> None:
+        self.emit(trace.record())
+
+    def run(self, trace: Trace, func: Callable, *args: Any) -> Any:
+        self._local.trace = trace
+        try:
+            return func(*args)
+        finally:
+            self._local.trace = None
+
+    def handler(self, tag: str) -> Callable[[Callable], Callable]:
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(msg: Any) -> Any:
+                trace = self.start(msg, tag)
+                try:
+                    return self.run(trace, func, msg)
+                except BaseException as err:
+                    trace.fields['error'] = type(err).__name__
+                    raise
+                finally:
+                    self.finish(trace)
+            return wrapper
+        return decorator
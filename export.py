@@ -0,0 +1,173 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import csv
+from datetime import datetime as dt
+import json
+import os
+from pathlib import Path
+import shutil
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from codec import unpack_entry, unpack_state
+from storage import Backend, HISTORY_SLOTS, logged_uids, open_backend, SQLiteBackend
+
+
+STATE_FIELDS = ['uid', 'plays', 'points', 'attempts', 'tasks_left', 'hseq']
+HISTORY_FIELDS = ['uid', 'seq', 'date', 'tag', 'text', 'answer', 'sticker']
+
+
+class JsonlWriter:
+    def __init__(self, path: str, fields: List[str]):
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, row: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(row, ensure_ascii=False))
+        self._file.write('\n')
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class CsvWriter:
+    def __init__(self, path: str, fields: List[str]):
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+        self._writer = csv.DictWriter(self._file, fields, extrasaction='ignore')
+        self._writer.writeheader()
+
+    def write(self, row: Dict[str, Any]) -> None:
+        self._writer.writerow(row)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+WRITERS = {
+    'jsonl': JsonlWriter,
+    'csv': CsvWriter,
+}
+
+
+@contextmanager
+def open_snapshot(kind: str, path: str, log: Optional[str] = None) -> Iterator[Backend]:
+    if kind == 'sqlite':
+        backend = SQLiteBackend(path, readonly=True)
+        try:
+            with backend.snapshot():
+                yield backend
+        finally:
+            backend.close()
+        return
+
+    with TemporaryDirectory() as tmp:
+        copy = Path(tmp) / Path(path).name
+        shutil.copyfile(path, copy)
+        backend = open_backend(kind, str(copy))
+        try:
+            if log is not None:
+                backend.register(logged_uids(log))
+            yield backend
+        finally:
+            backend.close()
+
+
+def slot_to_seq(slot: int, hseq: int, slots: int) -> int:
+    return hseq - 1 - (hseq - 1 - slot) % slots
+
+
+def iter_users(backend: Backend,
+               slots: int = HISTORY_SLOTS,
+               ) -> Iterator[Tuple[Dict[str, Any], List[Tuple[int, Dict[str, Any]]]]]:
+    for uid in backend.uids():
+        data = backend.get(uid)
+        if data is None:
+            continue
+        state = unpack_state(data)
+        legacy = state.pop('history', None)
+        if legacy is not None:
+            state['hseq'] = len(legacy)
+            history = list(enumerate(legacy))
+        else:
+            hseq = state.get('hseq', 0)
+            history = sorted(
+                (
+                    (slot_to_seq(slot, hseq, slots), unpack_entry(value))
+                    for slot, value in backend.history(uid)
+                ),
+                key=lambda item: item[0],
+            )
+        yield state, history
+
+
+def export(backend: Backend,
+           states: Optional[Any] = None,
+           history: Optional[Any] = None,
+           tags: Optional[Set[str]] = None,
+           since: Optional[int] = None,
+           until: Optional[int] = None) -> Tuple[int, int]:
+    n_states = n_entries = 0
+    for state, entries in iter_users(backend):
+        if states is not None:
+            states.write({
+                'uid': state['uid'],
+                'plays': state.get('plays', False),
+                'points': state.get('points', 0),
+                'attempts': state.get('attempts', 0),
+                'tasks_left': len(state.get('tasks', [])),
+                'hseq': state.get('hseq', 0),
+            })
+            n_states += 1
+
+        if history is None:
+            continue
+        for seq, entry in entries:
+            if tags and entry.get('tag') not in tags:
+                continue
+            date = entry.get('date')
+            if (since is not None or until is not None) and date is None:
+                continue
+            if since is not None and date < since or until is not None and date >= until:
+                continue
+            history.write({'uid': state['uid'], 'seq': seq, **entry})
+            n_entries += 1
+    return n_states, n_entries
+
+
+def parse_date(text: str) -> int:
+    return int(dt.fromisoformat(text).timestamp())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Export user states and histories from a snapshot of the DB')
+    parser.add_argument('--backend', default=os.environ.get('STORAGE_BACKEND', 'vedis'))
+    parser.add_argument(
+        '--db',
+        default=str(Path('snapshots') / Path(os.environ.get('DB_PATH', 'history.db')).name),
+        help="DB snapshot written by the bot's cloud backups, not the live DB",
+    )
+    parser.add_argument('--log', help='userlogs.log to find users missing from the vedis index')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('--states', help='output file for user states')
+    parser.add_argument('--history', help='output file for flattened history rows')
+    parser.add_argument('--tag', action='append', help='keep only history rows with this tag (repeatable)')
+    parser.add_argument('--since', type=parse_date, help='ISO date, inclusive')
+    parser.add_argument('--until', type=parse_date, help='ISO date, exclusive')
+    args = parser.parse_args()
+
+    if not args.states and not args.history:
+        parser.error('nothing to export: pass --states and/or --history')
+
+    writer_cls = WRITERS[args.format]
+    states = writer_cls(args.states, STATE_FIELDS) if args.states else None
+    history = writer_cls(args.history, HISTORY_FIELDS) if args.history else None
+    try:
+        with open_snapshot(args.backend, args.db, args.log) as backend:
+            n_states, n_entries = export(
+                backend, states, history,
+                tags=set(args.tag or ()), since=args.since, until=args.until,
+            )
+    finally:
+        for writer in (states, history):
+            if writer is not None:
+                writer.close()
+    print(f'Exported {n_states} states and {n_entries} history rows')
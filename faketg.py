@@ -0,0 +1,220 @@
+from argparse import ArgumentParser
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import random
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep, time
+from typing import Any, Deque, Dict, List
+from urllib.parse import parse_qsl, urlsplit
+
+
+BENCH_TEXTS = [
+    'привет',
+    'здравствуй, котик',
+    '/help',
+    '/start',
+    '/score',
+    '/rank',
+    'расскажи что-нибудь',
+    'мне скучно',
+]
+
+
+class FakeTelegram:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self._updates: List[Dict[str, Any]] = []
+        self._cond = Condition()
+        self._lock = Lock()
+        self._next_id = 1
+        self._outstanding: Dict[int, Deque[float]] = defaultdict(deque)
+        self.latencies: List[float] = []
+        self.replies = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def api_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def make_update(self, chat_id: int, text: str) -> Dict[str, Any]:
+        with self._lock:
+            update_id = self._next_id
+            self._next_id += 1
+            self._outstanding[chat_id].append(monotonic())
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+                'text': text,
+            },
+        }
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        with self._cond:
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get('offset', 0) or 0)
+        deadline = monotonic() + float(params.get('timeout', 0) or 0)
+        with self._cond:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and monotonic() < deadline:
+                self._cond.wait(deadline - monotonic())
+            return list(self._updates[:int(params.get('limit', 100) or 100)])
+
+    def _sent(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        with self._lock:
+            self.replies += 1
+            if self._outstanding[chat_id]:
+                self.latencies.append(monotonic() - self._outstanding[chat_id].popleft())
+            message_id = self.replies
+        return {
+            'message_id': message_id,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    def _call(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method in ('sendMessage', 'sendSticker'):
+            return self._sent(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+        return True
+
+    def _make_handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self) -> None:
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if body:
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode('utf-8')))
+                method = url.path.rsplit('/', 1)[-1]
+                data = json.dumps({'ok': True, 'result': fake._call(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return Handler
+
+    def wait_replies(self, expected: int, timeout: float) -> bool:
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if len(self.latencies) >= expected:
+                return True
+            sleep(0.05)
+        return False
+
+    def shutdown(self) -> None:
+        self.httpd.shutdown()
+
+
+def prepare_workdir(workdir: str) -> None:
+    root = Path(__file__).absolute().parent
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    for name in ('texts', 'swears'):
+        if not Path(name).exists():
+            Path(name).symlink_to(root / name)
+    for name in ('userlogs.log', 'history.sqlite'):
+        Path(name).touch()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark webhook vs polling against a local fake Telegram API')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='webhook')
+    parser.add_argument('--workdir', default='tg-bench', help='scratch directory for the bot files')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 for as fast as possible')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    prepare_workdir(args.workdir)
+    os.environ.update({
+        'BOT_TOKEN': '123:bench',
+        'CLOUD_BACKEND': 'local',
+        'STORAGE_BACKEND': 'sqlite',
+        'DB_PATH': 'history.sqlite',
+    })
+
+    fake = FakeTelegram()
+    from telebot import apihelper
+    apihelper.API_URL = fake.api_url
+
+    import requests
+
+    from cloud import percentiles
+    from ngrams import Talker
+    import bot
+
+    bot.talker = Talker(n=4, delta=1e-2)
+    bot.prepare()
+
+    if args.mode == 'polling':
+        Thread(
+            target=bot.bot.infinity_polling,
+            kwargs={'timeout': 5, 'long_polling_timeout': 1},
+            daemon=True,
+        ).start()
+        deliver = fake.push_update
+    else:
+        server = bot.WebhookServer(
+            bot.bot.process_new_updates,
+            bot.tb.types.Update.de_json,
+            host='127.0.0.1',
+            port=0,
+            queue_size=bot.WEBHOOK_QUEUE_SIZE,
+            batch_size=bot.WEBHOOK_BATCH_SIZE,
+        )
+        Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.address
+        session = requests.Session()
+
+        def deliver(update: Dict[str, Any]) -> None:
+            while session.post(f'http://{host}:{port}{server.path}', json=update).status_code == 503:
+                sleep(0.01)
+
+    rng = random.Random(0)
+    started = monotonic()
+    for idx in range(args.messages):
+        deliver(fake.make_update(rng.randrange(1, args.chats + 1), rng.choice(BENCH_TEXTS)))
+        if args.rate:
+            sleep(max(0., started + (idx + 1) / args.rate - monotonic()))
+    done = fake.wait_replies(args.messages, args.timeout)
+    elapsed = monotonic() - started
+
+    print(f'mode: {args.mode}, delivered {args.messages} updates in {elapsed:.2f}s '
+          f'({args.messages / elapsed:.0f} msg/s){"" if done else ", timed out waiting for replies"}')
+    print('end-to-end latency:', percentiles(fake.latencies))
+    if bot.dispatcher is not None:
+        for worker in bot.dispatcher.metrics():
+            print(worker)
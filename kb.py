@@ -0,0 +1,209 @@
+from argparse import ArgumentParser
+from array import array
+from collections import Counter
+import heapq
+import json
+from math import log
+from mmap import ACCESS_READ, mmap
+import os
+from pathlib import Path
+from struct import calcsize, Struct
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from codec import pack_str, pack_varint, unpack_str, unpack_varint
+
+
+MAGIC = b'KB25'
+VERSION = 2
+HEADER = Struct('<4sIQQQQQ')
+
+Analyzer = Callable[[str], List[str]]
+
+
+def iter_texts(path: Path) -> Iterator[Tuple[str, str]]:
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield path.stem, line
+
+
+def iter_dump(path: Path) -> Iterator[Tuple[str, str]]:
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            article = json.loads(line)
+            summary = article.get('summary', '').strip()
+            if summary:
+                yield article.get('title', ''), summary
+
+
+def iter_sources(paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    for path in map(Path, paths):
+        if path.suffix == '.jsonl':
+            yield from iter_dump(path)
+        else:
+            yield from iter_texts(path)
+
+
+def _padded(data: bytes) -> bytes:
+    return data + bytes(-len(data) % 8)
+
+
+def build(docs: Iterable[Tuple[str, str]],
+          analyze: Analyzer,
+          first_sentence: Callable[[str], str],
+          path: str) -> int:
+    out = bytearray()
+    offsets = array('Q', [0])
+    lengths = array('I')
+    postings: Dict[str, bytearray] = {}
+    last_doc: Dict[str, int] = {}
+    df: Counter = Counter()
+
+    for doc_id, (title, text) in enumerate(docs):
+        answer = first_sentence(text)
+        terms = Counter(analyze(f'{title}\n{text}'))
+        pack_str(title, out)
+        pack_str(answer, out)
+        offsets.append(len(out))
+        lengths.append(sum(terms.values()))
+        for term, tf in terms.items():
+            buf = postings.setdefault(term, bytearray())
+            pack_varint(doc_id - last_doc.get(term, 0), buf)
+            pack_varint(tf, buf)
+            last_doc[term] = doc_id
+            df[term] += 1
+
+    terms = sorted(postings)
+    blob = bytearray()
+    term_offsets = array('Q', [0])
+    posting_offsets = array('Q', [0])
+    dfs = array('I')
+    for term in terms:
+        blob += term.encode('utf-8')
+        term_offsets.append(len(blob))
+        posting_offsets.append(posting_offsets[-1] + len(postings[term]))
+        dfs.append(df[term])
+
+    header = HEADER.pack(MAGIC, VERSION, len(lengths), len(terms), sum(lengths), len(out), len(blob))
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(header)
+        for table in (lengths, offsets, term_offsets, posting_offsets, dfs):
+            file.write(_padded(table.tobytes()))
+        file.write(_padded(out))
+        file.write(_padded(blob))
+        for term in terms:
+            file.write(postings[term])
+    os.replace(tmp, path)
+    return len(lengths)
+
+
+class KnowledgeBase:
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75, max_df_ratio: float = 0.25):
+        self.k1 = k1
+        self.b = b
+
+        with open(path, 'rb') as file:
+            self._data = mmap(file.fileno(), 0, access=ACCESS_READ)
+        if len(self._data) < HEADER.size or self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a knowledge base index')
+        _, version, n_docs, n_terms, total_length, docs_size, blob_size = HEADER.unpack_from(self._data)
+        if version != VERSION:
+            raise ValueError(f'Unsupported knowledge base version {version}, rebuild it with kb.py build')
+
+        self._view = memoryview(self._data)
+        pos = HEADER.size
+        self._tables = []
+        layout = [('I', n_docs), ('Q', n_docs + 1), ('Q', n_terms + 1), ('Q', n_terms + 1), ('I', n_terms)]
+        for code, count in layout:
+            size = count * calcsize(code)
+            self._tables.append(self._view[pos:pos + size].cast(code))
+            pos += size + -size % 8
+        self._lengths, self._offsets, self._term_offsets, self._posting_offsets, self._dfs = self._tables
+        self._docs = pos
+        self._blob = self._docs + docs_size + -docs_size % 8
+        self._postings = self._blob + blob_size + -blob_size % 8
+
+        self._n_terms = n_terms
+        self._n_docs = n_docs
+        self._max_df = max(1, int(max_df_ratio * n_docs))
+        self._avgdl = total_length / n_docs if n_docs else 1.
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def _find(self, term: str) -> int:
+        key = term.encode('utf-8')
+        data, offsets, blob = self._data, self._term_offsets, self._blob
+        lo, hi = 0, self._n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[blob + offsets[mid]:blob + offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_terms and data[blob + offsets[lo]:blob + offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def doc(self, doc_id: int) -> Tuple[str, str]:
+        title, pos = unpack_str(self._data, self._docs + self._offsets[doc_id])
+        answer, _ = unpack_str(self._data, pos)
+        return title, answer
+
+    def search(self, terms: Iterable[str], k: int = 1) -> List[Tuple[float, str, str]]:
+        data, lengths = self._data, self._lengths
+        k1, b, avgdl, n_docs = self.k1, self.b, self._avgdl, self._n_docs
+        scores: Dict[int, float] = {}
+        for term in set(terms):
+            idx = self._find(term)
+            if idx < 0:
+                continue
+            df = self._dfs[idx]
+            if df > self._max_df:
+                continue
+            idf = log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            pos = self._postings + self._posting_offsets[idx]
+            end = self._postings + self._posting_offsets[idx + 1]
+            doc_id = 0
+            while pos < end:
+                gap, pos = unpack_varint(data, pos)
+                tf, pos = unpack_varint(data, pos)
+                doc_id += gap
+                norm = tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[doc_id] / avgdl))
+                scores[doc_id] = scores.get(doc_id, 0.) + idf * norm
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, *self.doc(doc_id)) for doc_id, score in best]
+
+    def close(self) -> None:
+        for table in self._tables:
+            table.release()
+        self._view.release()
+        self._data.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build or query the offline BM25 knowledge base')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_cmd = commands.add_parser('build', help='index texts/*.txt lines or a JSONL dump of {title, summary}')
+    build_cmd.add_argument('sources', nargs='+')
+    build_cmd.add_argument('--out', default=os.environ.get('KB_PATH', 'kb.bin'))
+
+    query_cmd = commands.add_parser('query', help='print the best matches for a question')
+    query_cmd.add_argument('question')
+    query_cmd.add_argument('--index', default=os.environ.get('KB_PATH', 'kb.bin'))
+    query_cmd.add_argument('-k', type=int, default=5)
+
+    args = parser.parse_args()
+    from utils import get_first_sentence, lemmas
+
+    if args.command == 'build':
+        n_docs = build(iter_sources(args.sources), lemmas, get_first_sentence, args.out)
+        print(f'Indexed {n_docs} documents into {args.out} ({Path(args.out).stat().st_size} bytes)')
+    else:
+        for score, title, answer in KnowledgeBase(args.index).search(lemmas(args.question), args.k):
+            print(f'{score:8.3f}  [{title}] {answer}')
@@ -0,0 +1,81 @@
+from bisect import bisect_left, insort
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+
+class Leaderboard:
+    def __init__(self, max_points: int = 0):
+        self._lock = Lock()
+        self._tree = [0] * (max_points + 2)
+        self._points: Dict[int, int] = {}
+        self._by_points: Dict[int, Dict[int, None]] = {}
+        self._values: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._points
+
+    def _grow(self, points: int) -> None:
+        if points + 2 <= len(self._tree):
+            return
+        counts = {value: len(uids) for value, uids in self._by_points.items()}
+        self._tree = [0] * (2 * points + 2)
+        for value, count in counts.items():
+            self._add(value, count)
+
+    def _add(self, points: int, delta: int) -> None:
+        idx = points + 1
+        while idx < len(self._tree):
+            self._tree[idx] += delta
+            idx += idx & -idx
+
+    def _count_upto(self, points: int) -> int:
+        idx = min(points + 1, len(self._tree) - 1)
+        total = 0
+        while idx > 0:
+            total += self._tree[idx]
+            idx -= idx & -idx
+        return total
+
+    def _remove(self, uid: int) -> None:
+        points = self._points.pop(uid)
+        self._add(points, -1)
+        uids = self._by_points[points]
+        del uids[uid]
+        if not uids:
+            del self._by_points[points]
+            del self._values[bisect_left(self._values, points)]
+
+    def update(self, uid: int, points: int) -> None:
+        points = max(0, points)
+        with self._lock:
+            if self._points.get(uid) == points:
+                return
+            if uid in self._points:
+                self._remove(uid)
+            self._grow(points)
+            self._points[uid] = points
+            self._add(points, 1)
+            if points not in self._by_points:
+                self._by_points[points] = {}
+                insort(self._values, points)
+            self._by_points[points][uid] = None
+
+    def rank(self, uid: int) -> Optional[int]:
+        with self._lock:
+            if uid not in self._points:
+                return None
+            return len(self._points) - self._count_upto(self._points[uid]) + 1
+
+    def top(self, k: int) -> List[Tuple[int, int, int]]:
+        result = []
+        with self._lock:
+            for points in reversed(self._values):
+                rank = len(result) + 1
+                for uid in self._by_points[points]:
+                    if len(result) >= k:
+                        return result
+                    result.append((rank, uid, points))
+        return result
@@ -0,0 +1,235 @@
+import json
+from logging import getLogger
+import os
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from shutil import copyfile
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
+
+
+logger = getLogger(__name__)
+
+
+class SegmentedLog:
+    def __init__(self,
+                 active: str,
+                 directory: str,
+                 max_bytes: int = 4 << 20,
+                 max_secs: float = 24 * 60 * 60):
+        self.active = Path(active)
+        self.directory = Path(directory)
+        self.manifest_path = self.directory / 'manifest.json'
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+
+        self._lock = Lock()
+        self._manifest: Optional[Dict[str, Any]] = None
+        self._size: Optional[int] = None
+        self._file: Optional[BinaryIO] = None
+        self._started = monotonic()
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        if self._manifest is None:
+            if self.manifest_path.exists():
+                with open(self.manifest_path, 'r', encoding='utf-8') as file:
+                    self._manifest = json.load(file)
+            else:
+                self._manifest = {'segments': []}
+        return self._manifest
+
+    def _save_manifest(self) -> None:
+        self.directory.mkdir(exist_ok=True)
+        tmp = self.manifest_path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def _segment_name(self, seq: int) -> str:
+        return f'{self.active.stem}.{seq:06d}{self.active.suffix}'
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def _open(self) -> BinaryIO:
+        if self._file is not None and not self.active.exists():
+            self._close()
+        if self._file is None:
+            self._file = open(self.active, 'ab')
+            self._size = self._file.tell()
+        return self._file
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, text: str) -> None:
+        self.write_many([text])
+
+    def write_many(self, texts: List[str]) -> None:
+        data = ''.join(texts).encode('utf-8')
+        with self._lock:
+            self._open().write(data)
+            self._size += len(data)
+            if self._size >= self.max_bytes or monotonic() - self._started >= self.max_secs:
+                self._seal()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def seal(self) -> None:
+        with self._lock:
+            self._seal()
+
+    def _seal(self) -> None:
+        self._close()
+        if not self.active.exists() or not self.active.stat().st_size:
+            return
+        segments = self.manifest['segments']
+        name = self._segment_name(len(segments) + 1)
+        self.directory.mkdir(exist_ok=True)
+        os.replace(self.active, self.path(name))
+        self.active.touch()
+        segments.append({
+            'name': name,
+            'size': self.path(name).stat().st_size,
+            'uploaded': False,
+        })
+        self._save_manifest()
+        self._size = 0
+        self._started = monotonic()
+
+    def snapshot(self, dest: str) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            if self.active.exists():
+                copyfile(self.active, dest)
+            else:
+                Path(dest).write_bytes(b'')
+
+    def pending_uploads(self) -> List[str]:
+        with self._lock:
+            return [
+                segment['name']
+                for segment in self.manifest['segments']
+                if not segment['uploaded'] and self.path(segment['name']).exists()
+            ]
+
+    def mark_uploaded(self, name: str) -> None:
+        with self._lock:
+            for segment in self.manifest['segments']:
+                if segment['name'] == name:
+                    segment['uploaded'] = True
+            self._save_manifest()
+
+    def restore_manifest(self, manifest: Dict[str, Any]) -> None:
+        with self._lock:
+            self._manifest = manifest
+            self._save_manifest()
+
+    def missing(self) -> List[str]:
+        with self._lock:
+            names = [segment['name'] for segment in self.manifest['segments']]
+        return [name for name in names if not self.path(name).exists()]
+
+    def paths(self, fetch: Optional[Callable[[str], None]] = None) -> Iterator[Path]:
+        with self._lock:
+            names = [segment['name'] for segment in self.manifest['segments']]
+        for name in names:
+            path = self.path(name)
+            if not path.exists() and fetch is not None:
+                fetch(name)
+            if path.exists():
+                yield path
+        if self.active.exists():
+            yield self.active
+
+
+class LogWriter:
+    def __init__(self,
+                 log: SegmentedLog,
+                 flush_secs: float = 1,
+                 flush_bytes: int = 64 << 10,
+                 max_batch: int = 512):
+        self.log = log
+        self.flush_secs = flush_secs
+        self.flush_bytes = flush_bytes
+        self.max_batch = max_batch
+
+        self._queue: SimpleQueue = SimpleQueue()
+        self._closed = False
+        self._writer = Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def write(self, text: str) -> None:
+        self._queue.put(text)
+
+    def write_event(self, record: Dict[str, Any]) -> None:
+        self._queue.put(record)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        done = Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self.log.close()
+
+    def _write_loop(self) -> None:
+        unflushed = 0
+        last_flush = monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_secs)
+            except Empty:
+                item = Event()
+
+            batch: List[str] = []
+            waiters: List[Event] = []
+            stop = False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, Event):
+                    waiters.append(item)
+                elif isinstance(item, dict):
+                    batch.append(json.dumps(item, ensure_ascii=False) + '\n')
+                else:
+                    batch.append(item)
+                if stop or len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+
+            try:
+                if batch:
+                    self.log.write_many(batch)
+                    unflushed += sum(map(len, batch))
+                if unflushed and (stop or waiters or unflushed >= self.flush_bytes
+                                  or monotonic() - last_flush >= self.flush_secs):
+                    self.log.flush()
+                    unflushed = 0
+                    last_flush = monotonic()
+            except Exception:
+                logger.exception('Log writer failed')
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
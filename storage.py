@@ -0,0 +1,496 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+import random
+import re
+from shutil import copyfile
+import sqlite3
+from threading import Lock, Thread, local
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from vedis import Vedis
+
+
+Key = Union[int, Tuple[int, int]]
+
+USERS_SET = 'uids'
+HISTORY_SLOTS = 100
+
+
+class Backend:
+    concurrent_reads = False
+
+    def get(self, key: Key) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put_many(self, items: Iterable[Tuple[Key, bytes]]) -> None:
+        raise NotImplementedError
+
+    def uids(self) -> Iterator[int]:
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[Key, bytes]]:
+        raise NotImplementedError
+
+    def history(self, uid: int) -> List[Tuple[int, bytes]]:
+        raise NotImplementedError
+
+    def history_items(self) -> Iterator[Tuple[Key, bytes]]:
+        for uid in self.uids():
+            for slot, value in self.history(uid):
+                yield (uid, slot), value
+
+    def register(self, uids: Iterable[int]) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+    def backup(self, dest: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class VedisBackend(Backend):
+    def __init__(self, path: str, history_slots: int = HISTORY_SLOTS):
+        self.path = path
+        self.history_slots = history_slots
+        self._db: Optional[Vedis] = None
+        self._known: Set[int] = set()
+
+    @property
+    def db(self) -> Vedis:
+        if self._db is None:
+            self._db = Vedis(self.path)
+            self._known = set(map(int, self._db.smembers(USERS_SET)))
+        return self._db
+
+    @staticmethod
+    def _key(key: Key) -> Union[int, str]:
+        if isinstance(key, tuple):
+            uid, slot = key
+            return f'{uid}:h:{slot}'
+        return key
+
+    def get(self, key: Key) -> Optional[bytes]:
+        db, key = self.db, self._key(key)
+        if key not in db:
+            return None
+        return db[key]
+
+    def put_many(self, items: Iterable[Tuple[Key, bytes]]) -> None:
+        db = self.db
+        for key, value in items:
+            db[self._key(key)] = value
+            if not isinstance(key, tuple) and key not in self._known:
+                db.sadd(USERS_SET, key)
+                self._known.add(key)
+
+    def uids(self) -> Iterator[int]:
+        db = self.db
+        for uid in list(self._known):
+            if uid in db:
+                yield uid
+
+    def items(self) -> Iterator[Tuple[Key, bytes]]:
+        for uid in self.uids():
+            yield uid, self.get(uid)
+            for slot, value in self.history(uid):
+                yield (uid, slot), value
+
+    def history(self, uid: int) -> List[Tuple[int, bytes]]:
+        entries = []
+        for slot in range(self.history_slots):
+            value = self.get((uid, slot))
+            if value is not None:
+                entries.append((slot, value))
+        return entries
+
+    def register(self, uids: Iterable[int]) -> None:
+        db = self.db
+        for uid in uids:
+            if uid not in self._known and uid in db:
+                db.sadd(USERS_SET, uid)
+                self._known.add(uid)
+
+    def commit(self) -> None:
+        if self._db is not None:
+            self._db.commit()
+
+    def backup(self, dest: str) -> None:
+        self.commit()
+        copyfile(self.path, dest)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class SQLiteBackend(Backend):
+    concurrent_reads = True
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS states (uid INTEGER PRIMARY KEY, data BLOB NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS history ('
+        'uid INTEGER NOT NULL, slot INTEGER NOT NULL, data BLOB NOT NULL, '
+        'PRIMARY KEY (uid, slot)) WITHOUT ROWID',
+    )
+    GET_STATE = 'SELECT data FROM states WHERE uid = ?'
+    GET_ENTRY = 'SELECT data FROM history WHERE uid = ? AND slot = ?'
+    GET_HISTORY = 'SELECT slot, data FROM history WHERE uid = ? ORDER BY slot'
+    PUT_STATE = 'INSERT OR REPLACE INTO states (uid, data) VALUES (?, ?)'
+    PUT_ENTRY = 'INSERT OR REPLACE INTO history (uid, slot, data) VALUES (?, ?, ?)'
+    ALL_UIDS = 'SELECT uid FROM states ORDER BY uid'
+    ALL_STATES = 'SELECT uid, data FROM states ORDER BY uid'
+    ALL_ENTRIES = 'SELECT uid, slot, data FROM history ORDER BY uid, slot'
+
+    def __init__(self, path: str, fetch_size: int = 512, readonly: bool = False):
+        self.path = path
+        self.fetch_size = fetch_size
+        self.readonly = readonly
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = Lock()
+        self._readers = local()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.readonly:
+            uri = f'{Path(self.path).absolute().as_uri()}?mode=ro'
+            return sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=64)
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @property
+    def writer(self) -> sqlite3.Connection:
+        with self._writer_lock:
+            if self._writer is None:
+                conn = self._connect()
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+                conn.commit()
+                self._writer = conn
+        return self._writer
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            if self._writer is None and not self.readonly:
+                self.writer
+            conn = self._readers.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def snapshot(self) -> Iterator['SQLiteBackend']:
+        self.reader.execute('BEGIN')
+        try:
+            yield self
+        finally:
+            self.reader.rollback()
+
+    def get(self, key: Key) -> Optional[bytes]:
+        if isinstance(key, tuple):
+            row = self.reader.execute(self.GET_ENTRY, key).fetchone()
+        else:
+            row = self.reader.execute(self.GET_STATE, (key,)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put_many(self, items: Iterable[Tuple[Key, bytes]]) -> None:
+        states, entries = [], []
+        for key, value in items:
+            if isinstance(key, tuple):
+                entries.append((*key, value))
+            else:
+                states.append((key, value))
+        if states:
+            self.writer.executemany(self.PUT_STATE, states)
+        if entries:
+            self.writer.executemany(self.PUT_ENTRY, entries)
+
+    def _stream(self, query: str) -> Iterator[tuple]:
+        cursor = self.reader.execute(query)
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def uids(self) -> Iterator[int]:
+        for uid, in self._stream(self.ALL_UIDS):
+            yield uid
+
+    def items(self) -> Iterator[Tuple[Key, bytes]]:
+        for uid, data in self._stream(self.ALL_STATES):
+            yield uid, bytes(data)
+        yield from self.history_items()
+
+    def history_items(self) -> Iterator[Tuple[Key, bytes]]:
+        for uid, slot, data in self._stream(self.ALL_ENTRIES):
+            yield (uid, slot), bytes(data)
+
+    def history(self, uid: int) -> List[Tuple[int, bytes]]:
+        rows = self.reader.execute(self.GET_HISTORY, (uid,)).fetchall()
+        return [(slot, bytes(data)) for slot, data in rows]
+
+    def commit(self) -> None:
+        if self._writer is not None:
+            self._writer.commit()
+
+    def backup(self, dest: str) -> None:
+        self.commit()
+        target = sqlite3.connect(dest)
+        try:
+            self.writer.backup(target)
+        finally:
+            target.close()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.commit()
+            self._writer.close()
+            self._writer = None
+        conn = getattr(self._readers, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._readers.conn = None
+
+
+BACKENDS = {
+    'vedis': VedisBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def open_backend(kind: str, path: str) -> Backend:
+    if kind not in BACKENDS:
+        raise ValueError(f'Unknown storage backend: {kind}')
+    return BACKENDS[kind](path)
+
+
+class Store:
+    def __init__(self,
+                 backend: Backend,
+                 stripes: int = 64,
+                 commit_every: int = 1):
+        self.backend = backend
+        self.commit_every = max(1, commit_every)
+
+        self._db_lock = Lock()
+        self._locks = [Lock() for _ in range(max(1, stripes))]
+        self._pending = 0
+        self._uncommitted: Dict[Key, bytes] = {}
+
+    def lock(self, uid: int) -> Lock:
+        return self._locks[hash(uid) % len(self._locks)]
+
+    def _commit(self) -> None:
+        if self._pending:
+            self.backend.commit()
+        self._pending = 0
+        self._uncommitted.clear()
+
+    def read(self, key: Key) -> Optional[bytes]:
+        if self.backend.concurrent_reads:
+            value = self._uncommitted.get(key)
+            return self.backend.get(key) if value is None else value
+        with self._db_lock:
+            return self.backend.get(key)
+
+    def write_many(self, items: Iterable[Tuple[Key, bytes]], commit: bool = True) -> None:
+        items = list(items)
+        with self._db_lock:
+            self.backend.put_many(items)
+            self._pending += len(items)
+            if commit or self._pending >= self.commit_every:
+                self._commit()
+            elif self.backend.concurrent_reads:
+                self._uncommitted.update(items)
+
+    def uids(self) -> List[int]:
+        with self._db_lock:
+            return list(self.backend.uids())
+
+    def history_items(self, batch_users: int = 32) -> Iterator[Tuple[Key, bytes]]:
+        if self.backend.concurrent_reads:
+            yield from self.backend.history_items()
+            return
+        uids = self.uids()
+        for start in range(0, len(uids), batch_users):
+            with self._db_lock:
+                batch = [
+                    ((uid, slot), value)
+                    for uid in uids[start:start + batch_users]
+                    for slot, value in self.backend.history(uid)
+                ]
+            yield from batch
+
+    def register(self, uids: Iterable[int]) -> None:
+        with self._db_lock:
+            self.backend.register(uids)
+            self.backend.commit()
+
+    def commit(self) -> None:
+        with self._db_lock:
+            self._commit()
+
+    def backup(self, dest: str) -> None:
+        with self._db_lock:
+            self._commit()
+            self.backend.backup(dest)
+
+    def close(self) -> None:
+        with self._db_lock:
+            self._commit()
+            self.backend.close()
+
+
+def parse_target(target: str) -> Tuple[str, str]:
+    kind, _, path = target.partition(':')
+    if not path:
+        raise ValueError(f'Expected <backend>:<path>, got {target!r}')
+    return kind, path
+
+
+def logged_uids(log_path: str) -> Iterator[int]:
+    with open(log_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            match = re.match(r'(-?\d+) ', line)
+            if match is not None:
+                yield int(match.group(1))
+
+
+def migrate(src: Backend, dst: Backend, batch_size: int = 1000) -> int:
+    batch, total = [], 0
+    for item in src.items():
+        batch.append(item)
+        if len(batch) >= batch_size:
+            dst.put_many(batch)
+            dst.commit()
+            total += len(batch)
+            batch.clear()
+    if batch:
+        dst.put_many(batch)
+        dst.commit()
+        total += len(batch)
+    return total
+
+
+MESSAGE_MIX = {
+    'fallback': 40,
+    'qa': 20,
+    'greet': 10,
+    'tasks': 10,
+    'personal': 8,
+    'toxic': 5,
+    'media': 4,
+    'score': 3,
+}
+
+
+def benchmark(store: Store,
+              users: int,
+              messages: int,
+              threads: int,
+              history_slots: int = HISTORY_SLOTS) -> Dict[str, float]:
+    from codec import pack_entry, pack_state, unpack_state
+
+    tags, weights = zip(*MESSAGE_MIX.items())
+    latencies: List[float] = []
+    latencies_lock = Lock()
+
+    def worker(count: int, rng: random.Random) -> None:
+        timings = []
+        for _ in range(count):
+            uid = int(rng.paretovariate(1.2)) % users
+            tag = rng.choices(tags, weights)[0]
+            start = perf_counter()
+            with store.lock(uid):
+                data = store.read(uid)
+                if data is None:
+                    state = {
+                        'uid': uid, 'plays': False, 'tasks': [],
+                        'points': 0, 'attempts': 0, 'hseq': 0,
+                    }
+                else:
+                    state = unpack_state(data)
+                if tag == 'tasks':
+                    state['points'] += 1
+                entry = pack_entry({
+                    'uid': uid, 'tag': tag,
+                    'text': 'x' * rng.randint(5, 120),
+                    'answer': 'y' * rng.randint(5, 200),
+                })
+                slot = state['hseq'] % history_slots
+                state['hseq'] += 1
+                store.write_many(
+                    [((uid, slot), entry), (uid, pack_state(**state))],
+                    commit=False,
+                )
+            timings.append(perf_counter() - start)
+        with latencies_lock:
+            latencies.extend(timings)
+
+    jobs = [
+        Thread(target=worker, args=(messages // threads, random.Random(idx)))
+        for idx in range(threads)
+    ]
+    start = perf_counter()
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    store.commit()
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return {
+        'messages': len(latencies),
+        'seconds': elapsed,
+        'msg_per_sec': len(latencies) / elapsed,
+        'p50_ms': 1e3 * latencies[len(latencies) // 2],
+        'p99_ms': 1e3 * latencies[int(len(latencies) * 0.99)],
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Storage backend tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_cmd = commands.add_parser('migrate', help='copy all records between backends')
+    migrate_cmd.add_argument('src', help='source as <backend>:<path>, e.g. vedis:history.db')
+    migrate_cmd.add_argument('dst', help='destination as <backend>:<path>, e.g. sqlite:history.sqlite')
+    migrate_cmd.add_argument('--batch-size', type=int, default=1000)
+    migrate_cmd.add_argument('--log', help='userlogs.log to find users missing from the vedis index')
+
+    bench_cmd = commands.add_parser('bench', help='replay a synthetic message mix')
+    bench_cmd.add_argument('targets', nargs='+', help='scratch <backend>:<path> to benchmark')
+    bench_cmd.add_argument('--users', type=int, default=1000)
+    bench_cmd.add_argument('--messages', type=int, default=20000)
+    bench_cmd.add_argument('--threads', type=int, default=8)
+    bench_cmd.add_argument('--commit-every', type=int, default=32)
+
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        src = open_backend(*parse_target(args.src))
+        dst = open_backend(*parse_target(args.dst))
+        if args.log:
+            src.register(logged_uids(args.log))
+            src.commit()
+        copied = migrate(src, dst, args.batch_size)
+        src.close()
+        dst.close()
+        print(f'Copied {copied} records from {args.src} to {args.dst}')
+    else:
+        for target in args.targets:
+            kind, path = parse_target(target)
+            if Path(path).exists():
+                raise SystemExit(f'{path} already exists, the benchmark needs a scratch path')
+            store = Store(open_backend(kind, path), commit_every=args.commit_every)
+            stats = benchmark(store, args.users, args.messages, args.threads)
+            store.close()
+            print(kind, ' '.join(f'{name}={value:.2f}' for name, value in stats.items()))
@@ -0,0 +1,183 @@
+import gzip
+from hashlib import sha256
+import json
+from logging import getLogger
+import os
+from pathlib import Path
+from shutil import copyfileobj
+from threading import Lock
+from time import sleep
+from typing import Any, Callable, Dict, List, Optional
+
+from requests.exceptions import ConnectionError
+from yadisk.exceptions import ConflictError
+
+
+logger = getLogger(__name__)
+
+BLOB_DIR = 'blobs'
+MANIFEST_NAME = 'sync.json'
+CHUNK_SIZE = 1 << 20
+
+
+def file_sha256(path: str) -> str:
+    digest = sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobSync:
+    def __init__(self,
+                 client: Any,
+                 root: str,
+                 local_dir: str,
+                 retries: int = 4,
+                 backoff_secs: float = 2):
+        self.client = client
+        self.root = root
+        self.local_dir = Path(local_dir)
+        self.manifest_path = self.local_dir / MANIFEST_NAME
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+
+        self._lock = Lock()
+        self._manifest: Optional[Dict[str, Dict[str, Any]]] = None
+        self._stale: List[str] = []
+        self._changed = False
+
+    def remote(self, name: str) -> str:
+        return f'{self.root}/{name}'
+
+    @property
+    def manifest(self) -> Dict[str, Dict[str, Any]]:
+        if self._manifest is None:
+            if self.manifest_path.exists():
+                with open(self.manifest_path, 'r', encoding='utf-8') as file:
+                    self._manifest = json.load(file)
+            else:
+                self._manifest = {}
+        return self._manifest
+
+    def _retrying(self, action: Callable[[], None], what: str) -> bool:
+        for attempt in range(self.retries):
+            try:
+                action()
+                return True
+            except (ConflictError, ConnectionError) as err:
+                delay = self.backoff_secs * 2 ** attempt
+                logger.info(f'{type(err).__name__} on {what}, retrying in {delay:.0f}s :(')
+                sleep(delay)
+        return False
+
+    def _replace(self, source: str, name: str) -> None:
+        yapath = self.remote(name)
+        if self.client.exists(yapath):
+            self.client.remove(yapath, permanently=True)
+            sleep(0.1)
+        self.client.upload(source, yapath)
+
+    def _put_blob(self, source: str, name: str) -> None:
+        yapath = self.remote(name)
+        if not self.client.exists(yapath):
+            self.client.upload(source, yapath)
+
+    def _ensure_dir(self, name: str) -> None:
+        yapath = self.remote(name)
+        if not self.client.exists(yapath):
+            self.client.mkdir(yapath)
+
+    def upload(self, filename: str, source: Optional[str] = None) -> bool:
+        source = source or filename
+        if not Path(source).exists():
+            return True
+        digest = file_sha256(source)
+        with self._lock:
+            entry = self.manifest.get(filename)
+        if entry is not None and entry['sha256'] == digest:
+            return True
+
+        self.local_dir.mkdir(exist_ok=True)
+        blob = f'{BLOB_DIR}/{digest}.gz'
+        packed = self.local_dir / f'{digest}.gz'
+        with open(source, 'rb') as src, gzip.open(packed, 'wb') as dst:
+            copyfileobj(src, dst, CHUNK_SIZE)
+        try:
+            uploaded = self._retrying(lambda: self._ensure_dir(BLOB_DIR), BLOB_DIR) \
+                and self._retrying(lambda: self._put_blob(str(packed), blob), filename)
+        finally:
+            packed.unlink(missing_ok=True)
+        if not uploaded:
+            return False
+
+        with self._lock:
+            if entry is not None:
+                self._stale.append(entry['blob'])
+            self.manifest[filename] = {
+                'sha256': digest,
+                'blob': blob,
+                'size': Path(source).stat().st_size,
+            }
+            self._changed = True
+        return True
+
+    def commit(self) -> bool:
+        with self._lock:
+            if not self._changed:
+                return True
+            self.local_dir.mkdir(exist_ok=True)
+            tmp = self.manifest_path.with_suffix('.tmp')
+            with open(tmp, 'w', encoding='utf-8') as file:
+                json.dump(self.manifest, file, indent=1)
+            os.replace(tmp, self.manifest_path)
+            referenced = {entry['blob'] for entry in self.manifest.values()}
+            stale = [blob for blob in self._stale if blob not in referenced]
+            self._stale.clear()
+            self._changed = False
+
+        if not self._retrying(lambda: self._replace(str(self.manifest_path), MANIFEST_NAME), MANIFEST_NAME):
+            with self._lock:
+                self._changed = True
+            return False
+        for blob in stale:
+            try:
+                self.client.remove(self.remote(blob), permanently=True)
+            except Exception:
+                logger.info(f'Could not remove stale blob {blob}')
+        return True
+
+    def pull_manifest(self) -> None:
+        with self._lock:
+            if self.manifest_path.exists():
+                return
+            yapath = self.remote(MANIFEST_NAME)
+            if not self.client.exists(yapath):
+                return
+            self.local_dir.mkdir(exist_ok=True)
+            self.client.download(yapath, str(self.manifest_path))
+            self._manifest = None
+
+    def restore(self, filename: str, dest: Optional[str] = None) -> bool:
+        dest = Path(dest or filename)
+        with self._lock:
+            entry = self.manifest.get(filename)
+        if entry is None:
+            return False
+
+        self.local_dir.mkdir(exist_ok=True)
+        packed = self.local_dir / Path(entry['blob']).name
+        unpacked = dest.with_name(f'{dest.name}.restore')
+        try:
+            self.client.download(self.remote(entry['blob']), str(packed))
+            with gzip.open(packed, 'rb') as src, open(unpacked, 'wb') as dst:
+                copyfileobj(src, dst, CHUNK_SIZE)
+            digest = file_sha256(str(unpacked))
+            if digest != entry['sha256']:
+                raise ValueError(f'Checksum mismatch for {filename}: {digest} != {entry["sha256"]}')
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(unpacked, dest)
+        finally:
+            packed.unlink(missing_ok=True)
+            unpacked.unlink(missing_ok=True)
+        return True
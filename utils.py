@@ -1,52 +1,90 @@
+import atexit
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from contextlib import contextmanager
 from datetime import datetime as dt
 import json
 from logging import Formatter, getLogger, INFO, Logger, StreamHandler
+from logging.handlers import QueueHandler, QueueListener
 import os
 from pathlib import Path
+from queue import SimpleQueue
 from random import random, seed, shuffle
 import re
-from threading import Lock
-from time import sleep
-from typing import Any, Dict, List, Optional
+from threading import Event, Lock
+from time import monotonic, perf_counter
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
 import unicodedata
 
 from pymorphy2 import MorphAnalyzer
-from razdel import sentenize
-from requests.exceptions import ConnectionError
-from vedis import Vedis
-import wikipedia as wiki
-from yadisk import YaDisk
-from yadisk.exceptions import ConflictError
-
+from razdel import sentenize, tokenize
+from requests.exceptions import RequestException
+
+from answers import AnswerCache
+from cache import StateCache
+from cloud import open_cloud
+from codec import pack_entry, pack_state, unpack_state
+from events import Tracer
+from kb import KnowledgeBase
+from leaderboard import Leaderboard
+from logs import LogWriter, SegmentedLog
+from storage import HISTORY_SLOTS, logged_uids, open_backend, Store
+from sync import BlobSync
 from tasks import Task, TASKS, MAX_ATTEMPTS
+from wikiapi import WikiClient
 
 
 MORPH = MorphAnalyzer()
 
 
-def get_logger(name: str) -> Logger:
-    log_format = Formatter('[%(asctime)s] [%(levelname)s] - %(message)s')
+def get_logger(name: str, queue: SimpleQueue) -> Logger:
     logger = getLogger(name)
     logger.setLevel(INFO)
+    logger.addHandler(QueueHandler(queue))
+
+    return logger
+
+
+def get_log_listener(queue: SimpleQueue) -> QueueListener:
+    log_format = Formatter('[%(asctime)s] [%(levelname)s] - %(message)s')
 
     handler = StreamHandler()
     handler.setLevel(INFO)
     handler.setFormatter(log_format)
-    logger.addHandler(handler)
 
-    return logger
+    return QueueListener(queue, handler)
 
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '@trash')
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'sync')
 YADISK_TOKEN = os.environ.get('YADISK_TOKEN', '#trash')
-
-logger = get_logger('@pathos_santa_bot')
-ya = YaDisk(token=YADISK_TOKEN)
+CLOUD_BACKEND = os.environ.get('CLOUD_BACKEND', 'yadisk')
+CLOUD_LOCAL_DIR = os.environ.get('CLOUD_LOCAL_DIR', 'cloud')
+
+log_queue: SimpleQueue = SimpleQueue()
+logger = get_logger('@pathos_santa_bot', log_queue)
+log_listener = get_log_listener(log_queue)
+log_listener.start()
+ya = open_cloud(
+    CLOUD_BACKEND,
+    YADISK_TOKEN,
+    local_dir=CLOUD_LOCAL_DIR,
+    latency_secs=float(os.environ.get('CLOUD_LATENCY_MS', 0)) / 1000,
+    throughput_bps=float(os.environ.get('CLOUD_THROUGHPUT_KBPS', 0)) * 1024,
+    conflict_prob=float(os.environ.get('CLOUD_CONFLICT_PROB', 0)),
+    error_prob=float(os.environ.get('CLOUD_ERROR_PROB', 0)),
+)
 lock = Lock()
+talker_lock = Lock()
+files_ready = Event()
 
 YADISK_PATH = '/pathos_santa_bot'
-DB_PATH = 'history.db'
+DB_PATH = os.environ.get('DB_PATH', 'history.db')
+ANSWERS_PATH = os.environ.get('ANSWERS_PATH', 'answers.db')
+KB_PATH = os.environ.get('KB_PATH', 'kb.bin')
 LOG_PATH = 'userlogs.log'
+LOG_DIR = 'logs'
+SNAPSHOT_DIR = 'snapshots'
 TEXT_PATHS = [
     'texts/python.txt',
     'texts/cats.txt',
@@ -54,91 +92,254 @@ TEXT_PATHS = [
     'texts/sweet.txt',
 ]
 
-MAX_HISTORY = 100
+MAX_HISTORY = HISTORY_SLOTS
 CLOUD_SLEEP_MINS = 10
+LOG_SEGMENT_BYTES = int(os.environ.get('LOG_SEGMENT_BYTES', 4 << 20))
+LOG_SEGMENT_HOURS = float(os.environ.get('LOG_SEGMENT_HOURS', 24))
+UPLOAD_RETRIES = int(os.environ.get('UPLOAD_RETRIES', 4))
+UPLOAD_BACKOFF_SECS = float(os.environ.get('UPLOAD_BACKOFF_SECS', 2))
+LOG_FLUSH_SECS = float(os.environ.get('LOG_FLUSH_SECS', 1))
+LOG_FLUSH_BYTES = int(os.environ.get('LOG_FLUSH_BYTES', 64 << 10))
 MAX_QUESTION_LEN = 256
+TOP_SIZE = 10
 NGRAM_PROBABILITY = 0.75
 STICKER_PROBABILITY = 0.15
 
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'vedis')
+DB_STRIPES = int(os.environ.get('DB_STRIPES', 64))
+STATE_CACHE_SIZE = int(os.environ.get('STATE_CACHE_SIZE', 4096))
+STATE_FLUSH_SECS = float(os.environ.get('STATE_FLUSH_SECS', 20))
+STATE_MAX_DIRTY = int(os.environ.get('STATE_MAX_DIRTY', 1024))
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 32))
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 256))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1024))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 64))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 20000))
+ANSWER_TTL_DAYS = float(os.environ.get('ANSWER_TTL_DAYS', 30))
+ANSWER_NEGATIVE_TTL_MINS = float(os.environ.get('ANSWER_NEGATIVE_TTL_MINS', 30))
+KB_MIN_SCORE = float(os.environ.get('KB_MIN_SCORE', 8))
+WIKI_LANG = os.environ.get('WIKI_LANG', 'ru')
+WIKI_DEADLINE_SECS = float(os.environ.get('WIKI_DEADLINE_SECS', 4))
+WIKI_HEDGE_SECS = float(os.environ.get('WIKI_HEDGE_SECS', 0.5))
+WIKI_CANDIDATES = int(os.environ.get('WIKI_CANDIDATES', 3))
+WIKI_WORKERS = int(os.environ.get('WIKI_WORKERS', 16))
+WIKI_SEARCH_ERRORS = {'wiki-json-exc', 'wiki-search-exc', 'wiki-unkn-exc-search'}
+WIKI_DEFINITE = {'wiki-found', 'wiki-no-res', 'wiki-no-page'}
+WARMUP_QUESTIONS = int(os.environ.get('WARMUP_QUESTIONS', 300))
+WARMUP_MIN_COUNT = int(os.environ.get('WARMUP_MIN_COUNT', 2))
+WARMUP_RATE = float(os.environ.get('WARMUP_RATE', 1))
+
+store = Store(open_backend(STORAGE_BACKEND, DB_PATH), stripes=DB_STRIPES)
+
+answer_cache = AnswerCache(
+    ANSWERS_PATH,
+    capacity=ANSWER_CACHE_SIZE,
+    ttl_secs=ANSWER_TTL_DAYS * 24 * 60 * 60,
+    negative_ttl_secs=ANSWER_NEGATIVE_TTL_MINS * 60,
+)
+knowledge = KnowledgeBase(KB_PATH) if Path(KB_PATH).exists() else None
+wiki_pool = ThreadPoolExecutor(WIKI_WORKERS, thread_name_prefix='wiki')
+wiki_client = WikiClient(WIKI_LANG, timeout=WIKI_DEADLINE_SECS, pool_size=WIKI_WORKERS)
+
+
+cloud_sync = BlobSync(
+    ya,
+    YADISK_PATH,
+    SNAPSHOT_DIR,
+    retries=UPLOAD_RETRIES,
+    backoff_secs=UPLOAD_BACKOFF_SECS,
+)
+userlog = SegmentedLog(
+    LOG_PATH,
+    LOG_DIR,
+    max_bytes=LOG_SEGMENT_BYTES,
+    max_secs=LOG_SEGMENT_HOURS * 60 * 60,
+)
+log_writer = LogWriter(userlog, flush_secs=LOG_FLUSH_SECS, flush_bytes=LOG_FLUSH_BYTES)
+tracer = Tracer(emit=log_writer.write_event)
+
 
 def roll_dice(prob: float) -> bool:
     return random() < prob
 
 
-def file_download(filename: str) -> None:
-    if not Path(filename).exists():
-        ya.download(f'{YADISK_PATH}/{filename}', filename)
+def file_download(filename: str, dest: Optional[str] = None) -> None:
+    dest = dest or filename
+    if not Path(dest).exists() and not cloud_sync.restore(filename, dest):
+        ya.download(f'{YADISK_PATH}/{filename}', dest)
 
 
-def file_upload(filename: str) -> None:
-    if Path(filename).exists():
-        yapath = f'{YADISK_PATH}/{filename}'
-        if ya.exists(yapath):
-            ya.remove(yapath, permanently=True)
-            sleep(0.1)
-        try:
-            ya.upload(filename, yapath)
-        except ConflictError:
-            logger.info('ConflictError :(')
+def download_log_manifest() -> None:
+    filename = f'{LOG_DIR}/{userlog.manifest_path.name}'
+    if userlog.manifest_path.exists() or filename not in cloud_sync.manifest:
+        return
+    remote_copy = f'{LOG_DIR}/manifest.remote.json'
+    file_download(filename, remote_copy)
+    with open(remote_copy, 'r', encoding='utf-8') as file:
+        userlog.restore_manifest(json.load(file))
+    Path(remote_copy).unlink()
+
+
+def fetch_log_segment(name: str) -> None:
+    try:
+        cloud_sync.restore(f'{LOG_DIR}/{name}', str(userlog.path(name)))
+    except Exception:
+        logger.info(f'Could not fetch log segment {name} :(')
+
+
+def log_paths() -> Iterator[Path]:
+    cloud_sync.pull_manifest()
+    download_log_manifest()
+    return userlog.paths(fetch=fetch_log_segment)
+
+
+def upload_log_segments() -> None:
+    pending = userlog.pending_uploads()
+    if not pending:
+        return
+    for name in pending:
+        if not cloud_sync.upload(f'{LOG_DIR}/{name}', str(userlog.path(name))):
+            logger.info(f'Gave up uploading {name}, will retry next time :(')
+            break
+        userlog.mark_uploaded(name)
+    cloud_sync.upload(f'{LOG_DIR}/{userlog.manifest_path.name}', str(userlog.manifest_path))
+
+
+def missing_files() -> List[str]:
+    log_files = () if userlog.manifest_path.exists() else (LOG_PATH,)
+    return [
+        filename
+        for filename in (*log_files, DB_PATH, *TEXT_PATHS)
+        if not Path(filename).exists()
+    ]
 
 
 def cloud_download_files() -> None:
     with lock:
         Path('texts').mkdir(exist_ok=True)
-        for filename in (LOG_PATH, DB_PATH, *TEXT_PATHS):
-            if not Path(filename).exists():
-                file_download(filename)
+        cloud_sync.pull_manifest()
+        for filename in missing_files():
+            file_download(filename)
+        if not Path(ANSWERS_PATH).exists():
+            cloud_sync.restore(ANSWERS_PATH)
+        download_log_manifest()
+        files_ready.set()
+
+
+def ensure_files() -> None:
+    if not files_ready.is_set():
+        cloud_download_files()
+
+
+def resync_files() -> bool:
+    if not missing_files():
+        return False
+    files_ready.clear()
+    cloud_download_files()
+    return True
+
+
+def take_snapshots() -> List[Tuple[str, str]]:
+    Path(SNAPSHOT_DIR).mkdir(exist_ok=True)
+    snapshots = []
+
+    log_snapshot = f'{SNAPSHOT_DIR}/{Path(LOG_PATH).name}'
+    log_writer.flush()
+    userlog.snapshot(log_snapshot)
+    snapshots.append((LOG_PATH, log_snapshot))
+
+    states.flush()
+    db_snapshot = f'{SNAPSHOT_DIR}/{Path(DB_PATH).name}'
+    db_tmp = f'{db_snapshot}.tmp'
+    Path(db_tmp).unlink(missing_ok=True)
+    store.backup(db_tmp)
+    os.replace(db_tmp, db_snapshot)
+    snapshots.append((DB_PATH, db_snapshot))
+
+    answers_snapshot = f'{SNAPSHOT_DIR}/{Path(ANSWERS_PATH).name}'
+    Path(answers_snapshot).unlink(missing_ok=True)
+    answer_cache.backup(answers_snapshot)
+    snapshots.append((ANSWERS_PATH, answers_snapshot))
+    return snapshots
 
 
 def cloud_upload_files() -> None:
-    with lock:
-        try:
-            file_upload(LOG_PATH)
-            file_upload(DB_PATH)
-        except ConnectionError:
-            logger.info('ConnectionError :(')
+    upload_log_segments()
+    for filename, snapshot in take_snapshots():
+        if not cloud_sync.upload(filename, snapshot):
+            logger.info(f'Gave up uploading {filename} :(')
+    if not cloud_sync.commit():
+        logger.info('Could not upload the sync manifest :(')
 
 
 def log(*args: Any) -> None:
-    with lock:
-        logger.info(f'Log: {args}')
-        with open(LOG_PATH, 'a', encoding='utf-8') as file:
-            print(*args, file=file)
+    logger.info(f'Log: {args}')
+    log_writer.write(' '.join(map(str, args)) + '\n')
+
+
+PLAYING_USERS: Set[int] = set()
+LEADERBOARD = Leaderboard(sum(task.points for task in TASKS))
+
+
+def history_key(uid: int, seq: int) -> Tuple[int, int]:
+    return uid, seq % MAX_HISTORY
 
 
 class UserState:
+    __slots__ = ('uid', 'plays', 'tasks', 'points', 'attempts', 'hseq', 'new_history')
+
     def __init__(self, uid: int, **kwargs: Any):
         self.uid: int = uid
         self.plays: bool = kwargs.get('plays', False)
         self.tasks: List[int] = kwargs.get('tasks', [])
         self.points: int = kwargs.get('points', 0)
         self.attempts: int = kwargs.get('attempts', 0)
-        self.history: List[Dict[str, str]] = kwargs.get('history', [])
+        self.hseq: int = kwargs.get('hseq', 0)
+        self.new_history: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=MAX_HISTORY)
+        for entry in kwargs.get('history', []):
+            self._push_history(entry)
 
     def _init_tasks(self) -> None:
         self.tasks = list(range(len(TASKS)))
         seed(self.uid)
         shuffle(self.tasks)
 
-    def to_json(self) -> str:
-        return json.dumps({
-            'uid': self.uid,
-            'plays': self.plays,
-            'tasks': self.tasks,
-            'points': self.points,
-            'attempts': self.attempts,
-            'history': self.history,
-        })
+    def encode(self) -> bytes:
+        return pack_state(
+            self.uid, self.plays, self.tasks,
+            self.points, self.attempts, self.hseq,
+        )
 
     @classmethod
-    def from_json(self, js: str) -> 'UserState':
-        kwargs = json.loads(js)
+    def decode(self, data: bytes) -> 'UserState':
+        kwargs = unpack_state(data)
         return UserState(**kwargs)
 
-    def append_history(self, **kwargs: str) -> None:
-        self.history.append(kwargs)
-        if len(self.history) > MAX_HISTORY:
-            self.history.pop(0)
+    def dump(self) -> List[Tuple[Any, bytes]]:
+        items = [
+            (history_key(self.uid, seq), pack_entry(entry))
+            for seq, entry in self.new_history
+        ]
+        items.append((self.uid, self.encode()))
+        self.new_history.clear()
+        return items
+
+    def _push_history(self, entry: Dict[str, Any]) -> None:
+        self.new_history.append((self.hseq, entry))
+        self.hseq += 1
+
+    def append_history(self, **kwargs: Any) -> None:
+        kwargs.setdefault('date', int(dt.now().timestamp()))
+        self._push_history(kwargs)
+
+    def add_points(self, points: int) -> None:
+        self.points += points
 
     def get_task(self) -> Task:
         return TASKS[self.tasks[-1]]
@@ -161,71 +362,185 @@ class UserState:
         self.attempts = MAX_ATTEMPTS
         self._init_tasks()
 
+    def snapshot(self) -> Tuple[bytes, List[Tuple[int, Dict[str, Any]]]]:
+        return self.encode(), list(self.new_history)
 
-def save_history(uid: int, state: UserState) -> None:
-    with lock:
-        with Vedis(DB_PATH) as db:
-            db[uid] = state.to_json()
+    def restore(self, snapshot: Tuple[bytes, List[Tuple[int, Dict[str, Any]]]]) -> None:
+        data, history = snapshot
+        for name, value in unpack_state(data).items():
+            setattr(self, name, value)
+        self.new_history.clear()
+        self.new_history.extend(history)
 
 
-def read_history(uid: int) -> UserState:
-    with lock:
-        with Vedis(DB_PATH) as db:
-            if uid not in db:
-                state = UserState(uid)
-                db[uid] = state.to_json()
-                return state
-            js = db[uid].decode()
-            return UserState.from_json(js)
+def index_state(state: UserState) -> None:
+    if state.is_playing() and state.has_tasks():
+        PLAYING_USERS.add(state.uid)
+    else:
+        PLAYING_USERS.discard(state.uid)
+    if state.is_playing():
+        LEADERBOARD.update(state.uid, state.points)
 
 
-def fetch_wiki(question: str, uid: int) -> Optional[wiki.wikipedia.WikipediaPage]:
-    time = dt.now().strftime('%d %b %Y %H:%M:%S')
-    results = []
-    page = None
+def _load_state(uid: int) -> UserState:
+    data = store.read(uid)
+    if data is None:
+        return UserState(uid)
+    return UserState.decode(data)
+
+
+states = StateCache(
+    load=_load_state,
+    encode=UserState.dump,
+    write=store.write_many,
+    lock_for=store.lock,
+    capacity=STATE_CACHE_SIZE,
+    flush_secs=STATE_FLUSH_SECS,
+    max_dirty=STATE_MAX_DIRTY,
+)
 
+
+def shutdown() -> None:
+    states.close()
+    log_writer.close()
+    answer_cache.close()
+    store.close()
+    log_listener.stop()
+
+
+atexit.register(shutdown)
+
+
+@contextmanager
+def user_state(uid: int) -> Iterator[UserState]:
+    start = perf_counter()
+    with store.lock(uid):
+        state = states.get(uid)
+        tracer.add('state_read', perf_counter() - start)
+        snapshot = state.snapshot()
+        try:
+            yield state
+        except BaseException:
+            state.restore(snapshot)
+            raise
+        with tracer.stage('state_write'):
+            states.mark_dirty(uid, state)
+        index_state(state)
+
+
+def index_users() -> None:
+    if not store.uids() and Path(LOG_PATH).exists():
+        store.register(logged_uids(LOG_PATH))
+
+
+def load_indexes() -> None:
+    playing = set()
+    for uid in store.uids():
+        data = store.read(uid)
+        if data is None:
+            continue
+        state = UserState.decode(data)
+        if state.is_playing() and state.has_tasks():
+            playing.add(uid)
+        if state.is_playing():
+            LEADERBOARD.update(uid, state.points)
+    PLAYING_USERS.clear()
+    PLAYING_USERS.update(playing)
+
+
+def first_wiki_summary(titles: List[str], deadline: float) -> Tuple[Optional[str], str]:
+    queued = list(titles)
+    pending = {wiki_pool.submit(wiki_client.summary, queued.pop(0))}
+    failed = False
     try:
-        results = wiki.search(question)
-    except json.decoder.JSONDecodeError:
-        log(uid, f'{time=}', '[wiki-json-exc]', f'{question=}')
-    except wiki.exceptions.WikipediaException:
-        log(uid, f'{time=}', '[wiki-search-exc]', f'{question=}')
-    except:
-        log(uid, f'{time=}', '[wiki-unkn-exc-search]', f'{question=}')
+        while pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None, 'wiki-timeout'
+            timeout = min(remaining, WIKI_HEDGE_SECS) if queued else remaining
+            done, pending = wait(pending, timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    summary = future.result()
+                except Exception:
+                    failed = True
+                    continue
+                if summary is not None:
+                    return summary, 'wiki-found'
+            if queued:
+                pending.add(wiki_pool.submit(wiki_client.summary, queued.pop(0)))
+        return None, 'wiki-unkn-exc-page' if failed else 'wiki-no-page'
     finally:
-        if not results:
-            log(uid, f'{time=}', '[wiki-no-res]', f'{question=}')
+        for future in pending:
+            future.cancel()
 
-    if not results:
-        return None
 
+def lookup_wiki(question: str) -> Tuple[Optional[str], str]:
+    deadline = monotonic() + WIKI_DEADLINE_SECS
     try:
-        page = wiki.page(results[0])
-        log(uid, f'{time=}', '[wiki-found]', f'{question=}')
-    except wiki.exceptions.DisambiguationError as err:
-        try:
-            page = wiki.page(err.options[0])
-            log(uid, f'{time=}', '[wiki-resolved]', f'{question=}')
-        except (wiki.exceptions.DisambiguationError, wiki.page.PageError):
-            log(uid, f'{time=}', '[wiki-exc-double]', f'{question=}')
-        except:
-            log(uid, f'{time=}', '[wiki-unkn-exc-double]', f'{question=}')
+        with tracer.stage('wiki_search'):
+            search = wiki_pool.submit(wiki_client.search, question, WIKI_CANDIDATES)
+            results = search.result(timeout=WIKI_DEADLINE_SECS)
+    except FutureTimeoutError:
+        search.cancel()
+        return None, 'wiki-timeout'
+    except ValueError:
+        return None, 'wiki-json-exc'
+    except RequestException:
+        return None, 'wiki-search-exc'
     except:
-        log(uid, f'{time=}', '[wiki-unkn-exc-page]', f'{question=}')
-    return page
+        return None, 'wiki-unkn-exc-search'
 
+    if not results:
+        return None, 'wiki-no-res'
+    with tracer.stage('wiki_page'):
+        return first_wiki_summary(results, deadline)
 
-def get_first_sentence(summary: str) -> str:
-    sents = list(map(lambda s: s.text, sentenize(summary)))
-    try:
-        answer = sents[0]
-        idx = 0
-        while re.search(r'\([^)]*$|«[^»]*$', answer) is not None:
-            idx += 1
-            answer = ' '.join((answer, sents[idx]))
-        return answer
-    except IndexError:
+
+def fetch_wiki(question: str, uid: int) -> Tuple[Optional[str], str]:
+    time = dt.now().strftime('%d %b %Y %H:%M:%S')
+    summary, status = lookup_wiki(question)
+    log(uid, f'{time=}', f'[{status}]', f'{question=}')
+    if status in WIKI_SEARCH_ERRORS:
+        log(uid, f'{time=}', '[wiki-no-res]', f'{question=}')
+    return summary, status
+
+
+def answer_from_summary(summary: Optional[str]) -> str:
+    if summary is None:
+        return ''
+    return postprocess_answer(get_first_sentence(summary))
+
+
+def lemmas(text: str) -> List[str]:
+    return [
+        MORPH.parse(token.text)[0].normal_form
+        for token in tokenize(text.lower().replace('ё', 'е'))
+        if any(c.isalnum() for c in token.text)
+    ]
+
+
+def question_key(question: str) -> str:
+    return ' '.join(lemmas(question))
+
+
+def kb_answer(terms: List[str]) -> str:
+    if knowledge is None:
         return ''
+    with tracer.stage('kb'):
+        found = knowledge.search(terms)
+    if not found or found[0][0] < KB_MIN_SCORE:
+        return ''
+    return postprocess_answer(found[0][2])
+
+
+def get_first_sentence(summary: str) -> str:
+    answer = ''
+    for sent in sentenize(summary):
+        answer = ' '.join((answer, sent.text)) if answer else sent.text
+        if re.search(r'\([^)]*$|«[^»]*$', answer) is None:
+            return answer
+    return ''
 
 
 def postprocess_answer(text: str) -> str:
@@ -236,5 +551,4 @@ def postprocess_answer(text: str) -> str:
 
 
 def is_playing(uid: int) -> bool:
-    state = read_history(uid)
-    return state.is_playing() and state.has_tasks()
+    return uid in PLAYING_USERS
@@ -0,0 +1,80 @@
+from ast import literal_eval
+from pathlib import Path
+from time import sleep
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from analytics import HeavyHitters, LINE_RE, read_lines, TEXT_RE
+from codec import unpack_entry
+from utils import (
+    answer_cache, answer_from_summary, kb_answer, logger, lookup_wiki,
+    MAX_QUESTION_LEN, question_key, store, userlog,
+    WARMUP_MIN_COUNT, WARMUP_QUESTIONS, WARMUP_RATE, WIKI_DEFINITE,
+)
+
+
+def logged_questions(paths: Iterable[Path]) -> Iterator[Tuple[int, str]]:
+    for line in read_lines(paths):
+        match = LINE_RE.match(line)
+        if match is None or match.group(3) != 'qa':
+            continue
+        text = TEXT_RE.search(match.group(4))
+        if text is None:
+            continue
+        try:
+            yield int(match.group(1)), literal_eval(text.group(1))
+        except (ValueError, SyntaxError):
+            continue
+
+
+def stored_questions() -> Iterator[Tuple[int, str]]:
+    for (uid, _), data in store.history_items():
+        entry = unpack_entry(data)
+        if entry.get('tag') == 'qa' and entry.get('text'):
+            yield uid, entry['text']
+
+
+def asked_questions() -> Iterator[str]:
+    logged_uids: Set[int] = set()
+    for uid, question in logged_questions(userlog.paths()):
+        logged_uids.add(uid)
+        yield question
+    for uid, question in stored_questions():
+        if uid not in logged_uids:
+            yield question
+
+
+def popular_questions(limit: int, capacity: int = 10000) -> List[Tuple[str, str, int]]:
+    hitters = HeavyHitters(capacity)
+    for question in asked_questions():
+        question = question.strip().lower()
+        if question and len(question) <= MAX_QUESTION_LEN and not question.endswith('<...>'):
+            hitters.add(question)
+
+    merged: Dict[str, Tuple[str, int]] = {}
+    for question, count in hitters.top(capacity):
+        key = question_key(question)
+        if not key:
+            continue
+        best, total = merged.get(key, (question, 0))
+        merged[key] = (best, total + count)
+    ranked = sorted(merged.items(), key=lambda item: -item[1][1])
+    return [(question, key, count) for key, (question, count) in ranked[:limit]]
+
+
+def warm_up(limit: int = WARMUP_QUESTIONS,
+            min_count: int = WARMUP_MIN_COUNT,
+            rate: float = WARMUP_RATE) -> int:
+    fetched = 0
+    for question, key, count in popular_questions(limit):
+        if count < min_count:
+            break
+        if kb_answer(key.split()) or answer_cache.get(key) is not None:
+            continue
+        summary, status = lookup_wiki(question)
+        if status in WIKI_DEFINITE:
+            answer_cache.put(key, answer_from_summary(summary))
+            fetched += 1
+        if rate > 0:
+            sleep(1 / rate)
+    logger.info(f'Warmed up the answer cache with {fetched} questions')
+    return fetched
@@ -0,0 +1,112 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable, List, Optional, Tuple
+
+
+logger = getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    def __init__(self,
+                 process: Callable[[List[Any]], None],
+                 parse: Callable[[str], Any],
+                 host: str = '127.0.0.1',
+                 port: int = 8443,
+                 path: str = '/webhook',
+                 secret: Optional[str] = None,
+                 queue_size: int = 1024,
+                 batch_size: int = 64,
+                 batch_secs: float = 0.):
+        self.process = process
+        self.parse = parse
+        self.path = path
+        self.secret = secret
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+
+        self._queue: Queue = Queue(maxsize=queue_size)
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._batcher = Thread(target=self._batch_loop, name='webhook-batcher', daemon=True)
+        self._batcher.start()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def _make_handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path != server.path:
+                    self._reply(404)
+                elif server.secret and self.headers.get(SECRET_HEADER) != server.secret:
+                    self._reply(403)
+                else:
+                    try:
+                        server._queue.put_nowait(body)
+                        self._reply(200)
+                    except Full:
+                        self._reply(503)
+
+            def _reply(self, code: int) -> None:
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return Handler
+
+    def _next_batch(self) -> Optional[List[bytes]]:
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = monotonic() + self.batch_secs
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0., deadline - monotonic())) \
+                    if self.batch_secs else self._queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            updates = []
+            for body in batch:
+                try:
+                    updates.append(self.parse(body.decode('utf-8')))
+                except Exception:
+                    logger.exception('Dropping a malformed update')
+            try:
+                self.process(updates)
+            except Exception:
+                logger.exception('Failed to process a batch of updates')
+
+    def serve_forever(self) -> None:
+        self.httpd.serve_forever()
+
+    def shutdown(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._queue.put(None)
+        self._batcher.join()
@@ -0,0 +1,46 @@
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+USER_AGENT = 'pathos_santa_bot (https://t.me/pathos_santa_bot)'
+
+
+class WikiClient:
+    def __init__(self, lang: str = 'ru', timeout: float = 4, pool_size: int = 16):
+        self.url = f'https://{lang}.wikipedia.org/w/api.php'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def _query(self, **params: Any) -> Dict[str, Any]:
+        params.update(action='query', format='json', formatversion=2)
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def search(self, query: str, limit: int = 3) -> List[str]:
+        data = self._query(list='search', srsearch=query, srlimit=limit, srprop='')
+        return [hit['title'] for hit in data.get('query', {}).get('search', [])]
+
+    def summary(self, title: str) -> Optional[str]:
+        data = self._query(
+            titles=title,
+            prop='extracts|pageprops',
+            ppprop='disambiguation',
+            exintro=1,
+            explaintext=1,
+            redirects=1,
+        )
+        pages = data.get('query', {}).get('pages', [])
+        if not pages:
+            return None
+        page = pages[0]
+        if page.get('missing') or 'disambiguation' in page.get('pageprops', {}):
+            return None
+        return page.get('extract') or None
+
+    def close(self) -> None:
+        self.session.close()